@@ -0,0 +1,689 @@
+"""Agent and skill catalog for the dot-agents repository.
+
+Collects agents and skills from their markdown frontmatter, keeps the
+incremental catalog and search indexes, and renders the plain README tree.
+Shared by list-agents-skills.py and update-readme-tree.py so neither has to
+run the other as a subprocess.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+from collections import Counter
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, TypeVar
+
+import yaml
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# libyaml's loader is several times faster when PyYAML was built with it
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+@dataclass
+class Skill:
+    name: str
+    description: str
+    path: Path
+
+
+@dataclass
+class Agent:
+    name: str
+    description: str
+    mode: str | None
+    path: Path
+
+
+# Frontmatter is a few hundred bytes; give up on files whose header never closes
+MAX_FRONTMATTER_BYTES = 64 * 1024
+
+
+def read_frontmatter_block(path: str | Path) -> bytes | None:
+    """Read only the leading YAML block of a markdown file, without its fences.
+
+    Lines are read from the start of the file until the closing ``---``, so the
+    body is never loaded. Returns None if the file does not open with ``---``
+    or the block is not closed within MAX_FRONTMATTER_BYTES.
+    """
+    with open(path, "rb") as handle:
+        first = handle.readline(MAX_FRONTMATTER_BYTES)
+        if first.rstrip() != b"---":
+            return None
+        lines = []
+        remaining = MAX_FRONTMATTER_BYTES - len(first)
+        while remaining > 0:
+            line = handle.readline(remaining)
+            if not line:
+                return None
+            if line.rstrip() == b"---":
+                return b"".join(lines)
+            lines.append(line)
+            remaining -= len(line)
+    return None
+
+
+def load_frontmatter_block(block: bytes | None) -> dict | None:
+    """Parse a block returned by read_frontmatter_block()."""
+    if not block or not block.strip():
+        return None
+    try:
+        return yaml.load(block.decode("utf-8"), Loader=SafeLoader)
+    except yaml.YAMLError:
+        return None
+
+
+INDEX_VERSION = 2
+
+
+def default_index_path() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "dot-agents" / "catalog-index.json"
+
+
+def default_search_index_path() -> Path:
+    return default_index_path().with_name("catalog-search.sqlite3")
+
+
+class CatalogIndex:
+    """On-disk index of parsed frontmatter and directory listings.
+
+    File entries record ``mtime_ns``, size and a hash of the frontmatter block
+    next to the parsed frontmatter: a file whose stat matches is never opened,
+    and one whose stat changed is only re-parsed if its header differs. Directory
+    entries cache their listing until the directory's own mtime changes, so
+    an unchanged tree is discovered with one ``stat`` per directory.
+
+    Lookups only add or replace single entries, so scanner threads may call
+    listing() and frontmatter() concurrently.
+    """
+
+    def __init__(self, path: Path, rebuild: bool = False) -> None:
+        self.path = path
+        self.files: dict[str, dict] = {}
+        self.dirs: dict[str, dict] = {}
+        self.seen: set[str] = set()
+        self.dirty = rebuild
+        if not rebuild:
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                data = None
+            if isinstance(data, dict) and data.get("version") == INDEX_VERSION:
+                self.files = data.get("files", {})
+                self.dirs = data.get("dirs", {})
+
+    def listing(self, directory: str) -> tuple[list[str], list[str]]:
+        """Return (subdirectories, other entries) of an absolute directory."""
+        self.seen.add(directory)
+        mtime_ns = os.stat(directory).st_mtime_ns
+        entry = self.dirs.get(directory)
+        if entry and entry["mtime_ns"] == mtime_ns:
+            return entry["dirs"], entry["files"]
+
+        subdirs, names = scan_directory(directory)
+        self.dirs[directory] = {"mtime_ns": mtime_ns, "dirs": subdirs, "files": names}
+        self.dirty = True
+        return subdirs, names
+
+    def frontmatter(self, file_path: Path) -> dict | None:
+        """Return the frontmatter of file_path, re-reading it only if changed."""
+        key = os.path.abspath(file_path)
+        self.seen.add(key)
+        stat = os.stat(key)
+        entry = self.files.get(key)
+        if (
+            entry
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            return entry["frontmatter"]
+
+        # Only the header is hashed: body edits never change the frontmatter
+        block = read_frontmatter_block(key)
+        digest = hashlib.blake2b(block or b"", digest_size=16).hexdigest()
+        if entry and entry["hash"] == digest:
+            frontmatter = entry["frontmatter"]
+        else:
+            frontmatter = load_frontmatter_block(block)
+        self.files[key] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": digest,
+            "frontmatter": frontmatter,
+        }
+        self.dirty = True
+        return frontmatter
+
+    def prune(self, directory: Path) -> None:
+        """Drop entries under directory that were not seen during this run."""
+        prefix = os.path.abspath(directory) + os.sep
+        for table in (self.files, self.dirs):
+            stale = [k for k in table if k.startswith(prefix) and k not in self.seen]
+            for key in stale:
+                del table[key]
+            self.dirty = self.dirty or bool(stale)
+
+    def save(self) -> None:
+        """Write the index atomically if anything changed."""
+        if not self.dirty:
+            return
+        data = {"version": INDEX_VERSION, "files": self.files, "dirs": self.dirs}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            partial = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            # default=str keeps YAML dates and other non-JSON scalars storable
+            partial.write_text(json.dumps(data, default=str), encoding="utf-8")
+            os.replace(partial, self.path)
+        except OSError as exc:
+            print(f"Warning: could not write index {self.path}: {exc}", file=sys.stderr)
+            return
+        self.dirty = False
+
+
+def scan_directory(directory: str) -> tuple[list[str], list[str]]:
+    """List directory, splitting real subdirectories from everything else."""
+    subdirs = []
+    names = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Like rglob, match symlinked files but do not descend symlinked dirs
+            if entry.is_dir() and not entry.is_symlink():
+                subdirs.append(entry.name)
+            else:
+                names.append(entry.name)
+    return subdirs, names
+
+
+def scan_map(pool: Executor | None, fn: Callable[[T], R], items: List[T]) -> List[R]:
+    """Apply fn to items on the pool, keeping input order."""
+    if pool is None or len(items) < 2:
+        return [fn(item) for item in items]
+    return list(pool.map(fn, items))
+
+
+def find_skill_files(
+    skills_dir: Path, index: CatalogIndex | None, pool: Executor | None = None
+) -> List[Path]:
+    """Find SKILL.md files below skills_dir, excluding skills_dir itself.
+
+    The tree is listed one level at a time so every directory on a level can
+    be read concurrently.
+    """
+    root = os.path.abspath(skills_dir)
+    list_dir = index.listing if index is not None else scan_directory
+    found = []
+    level = [root]
+    while level:
+        next_level = []
+        for directory, (subdirs, names) in zip(level, scan_map(pool, list_dir, level)):
+            if directory != root and "SKILL.md" in names:
+                found.append(Path(directory, "SKILL.md"))
+            next_level.extend(os.path.join(directory, name) for name in subdirs)
+        level = next_level
+    return sorted(found)
+
+
+def read_frontmatter(path: Path, index: CatalogIndex | None) -> dict | None:
+    if index is not None:
+        return index.frontmatter(path)
+    return load_frontmatter_block(read_frontmatter_block(path))
+
+
+def collect_skills(
+    src_path: Path, index: CatalogIndex | None = None, pool: Executor | None = None
+) -> List[Skill]:
+    """Collect all skills from the skills directory."""
+    skills_dir = src_path / "dot-agents" / "skills"
+    if not skills_dir.exists():
+        return []
+
+    paths = find_skill_files(skills_dir, index, pool)
+    parsed = scan_map(pool, lambda path: read_frontmatter(path, index), paths)
+
+    skills = []
+    for skill_path, frontmatter in zip(paths, parsed):
+        if frontmatter and "name" in frontmatter:
+            skills.append(
+                Skill(
+                    name=frontmatter.get("name", ""),
+                    description=frontmatter.get("description", "")
+                    .replace("\n", " ")
+                    .strip(),
+                    path=skill_path,
+                )
+            )
+
+    if index is not None:
+        index.prune(skills_dir)
+    return sorted(skills, key=lambda s: s.name)
+
+
+def collect_agents(
+    src_path: Path, index: CatalogIndex | None = None, pool: Executor | None = None
+) -> List[Agent]:
+    """Collect all agents from the agents directory."""
+    agents_dir = src_path / "dot-config" / "opencode" / "agents"
+    if not agents_dir.exists():
+        return []
+
+    paths = sorted(agents_dir.glob("*.md"))
+    parsed = scan_map(pool, lambda path: read_frontmatter(path, index), paths)
+
+    agents = []
+    for agent_path, frontmatter in zip(paths, parsed):
+        if frontmatter and "description" in frontmatter:
+            name = agent_path.stem
+            agents.append(
+                Agent(
+                    name=name,
+                    description=frontmatter.get("description", "").strip(),
+                    mode=frontmatter.get("mode"),
+                    path=agent_path,
+                )
+            )
+
+    if index is not None:
+        index.prune(agents_dir)
+    return sorted(agents, key=lambda a: a.name)
+
+
+def format_description(description: str, max_len: int | None = None) -> str:
+    """Clean description for display, optionally truncating."""
+    # Replace multiple spaces and newlines with single space
+    desc = " ".join(description.split())
+    if max_len and len(desc) > max_len:
+        # Find the last space before max_len to break at word boundary
+        trunc = desc[: max_len - 3]
+        last_space = trunc.rfind(" ")
+        if last_space > 0:
+            trunc = trunc[:last_space]
+        return trunc + "..."
+    return desc
+
+
+def extract_use_when(description: str, max_len: int = 100) -> str:
+    """Extract the 'Use when' sentence and truncate to max_len chars at word boundary."""
+    # Clean the description first
+    desc = " ".join(description.split())
+
+    # Find the "Use when" clause
+    match = re.search(r"Use when[^.]*\.", desc, re.IGNORECASE)
+    if match:
+        use_when = match.group(0)
+    else:
+        # Fallback: if no "Use when" found, use the whole description
+        use_when = desc
+
+    # Truncate at max_len to end of word
+    if len(use_when) > max_len:
+        trunc = use_when[:max_len]
+        last_space = trunc.rfind(" ")
+        if last_space > 0:
+            trunc = trunc[:last_space]
+        return trunc + "..."
+
+    return use_when
+
+
+# BM25F term-frequency multipliers; each field is length-normalized on its own.
+# References are long and mention many tools in passing, so their words count
+# for little next to the name and description that describe what a skill is for.
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "use_when": 2.0,
+    "description": 1.0,
+    "headings": 2.0,
+    "references": 0.25,
+}
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_INDEX_VERSION = 2
+STOPWORDS = frozenset(
+    "a an and are as at be by for from how i in into is it of on or that the "
+    "this to use used using when with you your".split()
+)
+
+
+def stem(word: str) -> str:
+    """Strip a few common English suffixes so "testing" matches "tests"."""
+    for suffix in ("ing", "es", "ed", "s"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[: -len(suffix)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, split on non-alphanumerics, drop stopwords and stem."""
+    return [
+        stem(word)
+        for word in re.findall(r"[a-z0-9]+", text.lower())
+        if word not in STOPWORDS
+    ]
+
+
+def markdown_headings(text: str) -> List[str]:
+    """Return ATX heading titles, ignoring lines inside fenced code blocks."""
+    headings = []
+    fenced = False
+    for line in text.splitlines():
+        stripped = line.lstrip()
+        if stripped.startswith(("```", "~~~")):
+            fenced = not fenced
+        elif not fenced and re.match(r"#{1,6}\s", stripped):
+            headings.append(stripped.lstrip("#").strip().rstrip("#").strip())
+    return headings
+
+
+@dataclass
+class SearchHit:
+    skill: Skill
+    score: float
+
+
+def skill_sources(
+    skill_dir: str, catalog: CatalogIndex | None
+) -> List[tuple[str, int, int]]:
+    """Return (path, mtime_ns, size) for SKILL.md and references/*.md."""
+    list_dir = catalog.listing if catalog is not None else scan_directory
+    paths = [os.path.join(skill_dir, "SKILL.md")]
+    if "references" in list_dir(skill_dir)[0]:
+        references = os.path.join(skill_dir, "references")
+        names = list_dir(references)[1]
+        paths.extend(
+            os.path.join(references, n) for n in sorted(names) if n.endswith(".md")
+        )
+    sources = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        sources.append((path, stat.st_mtime_ns, stat.st_size))
+    return sources
+
+
+def skill_terms(
+    skill: Skill, sources: List[tuple[str, int, int]]
+) -> dict[str, dict[str, int]]:
+    """Term frequencies per field for one skill document."""
+    fields = {
+        "name": [skill.name],
+        "use_when": [extract_use_when(skill.description)],
+        "description": [skill.description],
+        "headings": [],
+        "references": [],
+    }
+    for path, _, _ in sources:
+        try:
+            with open(path, encoding="utf-8", errors="replace") as handle:
+                text = handle.read()
+        except OSError:
+            continue
+        if os.path.basename(path) == "SKILL.md":
+            fields["headings"].extend(markdown_headings(text))
+        else:
+            fields["references"].append(text)
+
+    # Count raw words first so each distinct word is stemmed once per field
+    terms: dict[str, dict[str, int]] = {}
+    for field, texts in fields.items():
+        counts: dict[str, int] = {}
+        words = Counter(re.findall(r"[a-z0-9]+", " ".join(texts).lower()))
+        for word, count in words.items():
+            if word not in STOPWORDS:
+                term = stem(word)
+                counts[term] = counts.get(term, 0) + count
+        if counts:
+            terms[field] = counts
+    return terms
+
+
+class SearchIndex:
+    """SQLite-backed BM25F inverted index over skills.
+
+    One document per skill directory, with fields for its frontmatter name
+    and description, the extract_use_when() sentence, SKILL.md headings and
+    references/*.md. Postings and lengths are kept per field so a long
+    references field cannot drown out a matching name. Each document stores
+    the (path, mtime_ns, size) of its sources, and sync() rebuilds only
+    documents whose sources changed. Queries read just the postings of
+    their terms.
+    """
+
+    def __init__(self, path: Path, rebuild: bool = False) -> None:
+        import sqlite3
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+        if rebuild or version != SEARCH_INDEX_VERSION:
+            for table in ("postings", "fields", "docs"):
+                self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._conn.execute(f"PRAGMA user_version = {SEARCH_INDEX_VERSION}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            " id INTEGER PRIMARY KEY, root TEXT NOT NULL, path TEXT NOT NULL UNIQUE,"
+            " sources TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fields ("
+            " doc INTEGER NOT NULL, field TEXT NOT NULL, length INTEGER NOT NULL,"
+            " PRIMARY KEY (doc, field)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL, doc INTEGER NOT NULL, field TEXT NOT NULL,"
+            " tf INTEGER NOT NULL, PRIMARY KEY (term, doc, field)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)")
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def sync(
+        self,
+        root: str,
+        skills: List[Skill],
+        catalog: CatalogIndex | None,
+        pool: Executor | None = None,
+    ) -> int:
+        """Bring the documents under root up to date; return how many changed."""
+        stored = {
+            path: (doc_id, sources)
+            for doc_id, path, sources in self._conn.execute(
+                "SELECT id, path, sources FROM docs WHERE root = ?", (root,)
+            )
+        }
+        dirs = [str(skill.path.parent) for skill in skills]
+        sources = scan_map(pool, lambda d: skill_sources(d, catalog), dirs)
+        changed = [
+            (skill, skill_dir, json.dumps(found))
+            for skill, skill_dir, found in zip(skills, dirs, sources)
+            if stored.get(skill_dir, (None, None))[1] != json.dumps(found)
+        ]
+        removed = set(stored) - set(dirs)
+        if not changed and not removed:
+            return 0
+
+        terms = scan_map(
+            pool, lambda item: skill_terms(item[0], json.loads(item[2])), changed
+        )
+        with self._conn:
+            for skill_dir in removed:
+                self._delete(stored[skill_dir][0])
+            for (skill, skill_dir, found), doc_terms in zip(changed, terms):
+                if skill_dir in stored:
+                    self._delete(stored[skill_dir][0])
+                cursor = self._conn.execute(
+                    "INSERT INTO docs (root, path, sources) VALUES (?, ?, ?)",
+                    (root, skill_dir, found),
+                )
+                doc_id = cursor.lastrowid
+                self._conn.executemany(
+                    "INSERT INTO fields VALUES (?, ?, ?)",
+                    [
+                        (doc_id, field, sum(counts.values()))
+                        for field, counts in doc_terms.items()
+                    ],
+                )
+                self._conn.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?, ?)",
+                    [
+                        (term, doc_id, field, counts[term])
+                        for field, counts in doc_terms.items()
+                        for term in sorted(counts)
+                    ],
+                )
+        return len(changed) + len(removed)
+
+    def _delete(self, doc_id: int) -> None:
+        self._conn.execute("DELETE FROM postings WHERE doc = ?", (doc_id,))
+        self._conn.execute("DELETE FROM fields WHERE doc = ?", (doc_id,))
+        self._conn.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+
+    def search(self, root: str, query: str, limit: int) -> List[tuple[str, float]]:
+        """Return (skill directory, BM25F score) pairs, best first.
+
+        Each field's tf is normalized by that field's length against its
+        average over all documents (a missing field counts as length 0),
+        weighted, and summed before the one k1 saturation.
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        (count,) = self._conn.execute(
+            "SELECT COUNT(*) FROM docs WHERE root = ?", (root,)
+        ).fetchone()
+        if not count:
+            return []
+        avg_length = {
+            field: total / count
+            for field, total in self._conn.execute(
+                "SELECT f.field, SUM(f.length) FROM fields f"
+                " JOIN docs d ON d.id = f.doc WHERE d.root = ? GROUP BY f.field",
+                (root,),
+            )
+        }
+
+        placeholders = ", ".join("?" * len(terms))
+        rows = self._conn.execute(
+            "SELECT p.term, d.path, p.field, f.length, p.tf FROM postings p"
+            " JOIN docs d ON d.id = p.doc"
+            " JOIN fields f ON f.doc = p.doc AND f.field = p.field"
+            f" WHERE d.root = ? AND p.term IN ({placeholders})",
+            (root, *terms),
+        ).fetchall()
+        weighted: dict[tuple[str, str], float] = {}
+        for term, path, field, length, tf in rows:
+            norm = 1 - BM25_B + BM25_B * length / avg_length[field]
+            key = (term, path)
+            weighted[key] = weighted.get(key, 0.0) + FIELD_WEIGHTS[field] * tf / norm
+        frequency = Counter(term for term, _ in weighted)
+
+        scores: dict[str, float] = {}
+        for (term, path), tf in weighted.items():
+            df = frequency[term]
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            scores[path] = scores.get(path, 0.0) + idf * tf * (BM25_K1 + 1) / (
+                tf + BM25_K1
+            )
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit]
+
+
+def search_skills(
+    src_path: Path,
+    query: str,
+    limit: int,
+    search_index: SearchIndex,
+    catalog: CatalogIndex | None = None,
+    pool: Executor | None = None,
+) -> List[SearchHit]:
+    """Rank skills under src_path against query with BM25."""
+    skills = collect_skills(src_path, catalog, pool)
+    root = os.path.abspath(src_path / "dot-agents" / "skills")
+    search_index.sync(root, skills, catalog, pool)
+    by_dir = {str(skill.path.parent): skill for skill in skills}
+    return [
+        SearchHit(skill=by_dir[path], score=score)
+        for path, score in search_index.search(root, query, limit)
+        if path in by_dir
+    ]
+
+
+def build_tree_content(
+    skills: List[Skill],
+    agents: List[Agent],
+    show_descriptions: bool = False,
+    use_color: bool = True,
+) -> str:
+    """Build tree content as string, optionally with color codes."""
+    # Plain text tree without color codes
+    lines = ["dot-agents"]
+
+    if agents:
+        lines.append("├── Agents")
+        for i, agent in enumerate(agents):
+            is_last_agent = i == len(agents) - 1 and not skills
+            prefix = "│   └── " if is_last_agent else "│   ├── "
+            mode_str = f" ({agent.mode})" if agent.mode else ""
+            lines.append(f"{prefix}{agent.name}{mode_str}")
+            if show_descriptions:
+                desc = extract_use_when(agent.description)
+                # Indent description under agent
+                desc_prefix = "│       " if is_last_agent else "│   │   "
+                for line in _wrap_text(desc, 60):
+                    lines.append(f"{desc_prefix}{line}")
+
+    if skills:
+        lines.append("└── Skills")
+        for i, skill in enumerate(skills):
+            is_last = i == len(skills) - 1
+            prefix = "    └── " if is_last else "    ├── "
+            lines.append(f"{prefix}{skill.name}")
+            if show_descriptions:
+                desc = extract_use_when(skill.description)
+                desc_prefix = "        " if is_last else "    │   "
+                for line in _wrap_text(desc, 60):
+                    lines.append(f"{desc_prefix}{line}")
+
+    return "\n".join(lines)
+
+
+def _wrap_text(text: str, width: int) -> List[str]:
+    """Wrap text into lines of max width, breaking at word boundaries."""
+    if len(text) <= width:
+        return [text]
+
+    words = text.split()
+    lines = []
+    current_line = []
+    current_len = 0
+
+    for word in words:
+        if current_len + len(word) + (1 if current_line else 0) <= width:
+            current_line.append(word)
+            current_len += len(word) + (1 if current_len > 0 else 0)
+        else:
+            if current_line:
+                lines.append(" ".join(current_line))
+            current_line = [word]
+            current_len = len(word)
+
+    if current_line:
+        lines.append(" ".join(current_line))
+
+    return lines if lines else [text]
@@ -0,0 +1,205 @@
+#!/usr/bin/env -S pixi exec --spec python=3.14 --spec tiktoken --spec rich -- python
+"""Startup benchmark for token-summary.py.
+
+Runs short token-summary invocations under ``python -X importtime``, records
+the median wall time and total import time per scenario, and appends the run
+to a JSONL history so regressions show up as deltas against the last run.
+
+Usage:
+    bench-startup.py [--runs N] [--scenario NAME ...] [--budget-ms MS]
+
+Examples:
+    bench-startup.py                          # help + no-input scenarios
+    bench-startup.py --scenario json-small    # includes tiktoken load
+    bench-startup.py --budget-ms 25           # exit 1 if imports exceed 25 ms
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SCRIPT = Path(__file__).parent / "token-summary.py"
+SCENARIOS = {
+    "help": ["--help"],
+    "no-input": ["--stdin", "ignore"],
+    "json-small": [
+        "--json",
+        "--no-cache",
+        str(Path(__file__).parent.parent / "README.md"),
+    ],
+}
+DEFAULT_SCENARIOS = ["help", "no-input"]
+# "no-input" is a usage error on purpose: it times startup up to argparse.
+EXIT_CODES = {"no-input": 2}
+
+
+def default_history_path() -> Path:
+    base = os.environ.get("XDG_STATE_HOME") or Path.home() / ".local" / "state"
+    return Path(base) / "dot-agents" / "token-summary-startup.jsonl"
+
+
+def import_time_us(stderr: str) -> int:
+    """Sum the ``self`` column of ``-X importtime`` for imports after ``site``.
+
+    Interpreter startup (``site`` and its ``.pth`` hooks) is excluded so the
+    figure tracks what token-summary.py itself imports.
+    """
+    lines = [line for line in stderr.splitlines() if line.startswith("import time:")]
+    rows = [line[len("import time:") :].split("|") for line in lines]
+    start = 0
+    for index, fields in enumerate(rows):
+        if len(fields) == 3 and fields[2].rstrip() == " site":
+            start = index + 1
+    total = 0
+    for fields in rows[start:]:
+        if fields[0].strip().isdigit():
+            total += int(fields[0])
+    return total
+
+
+def run_once(python: str, name: str) -> tuple[float, int]:
+    """Time one run of scenario ``name``; exit if it does not exit as expected.
+
+    A crashing scenario would otherwise be timed and recorded as if it worked.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [python, "-X", "importtime", str(SCRIPT), *SCENARIOS[name]],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    expected = EXIT_CODES.get(name, 0)
+    if result.returncode != expected:
+        stderr = [
+            line
+            for line in result.stderr.splitlines()
+            if not line.startswith("import time:")
+        ]
+        raise SystemExit(
+            "\n".join(
+                [
+                    f"{name}: exited {result.returncode} (expected {expected}); "
+                    "nothing recorded",
+                    *stderr[-20:],
+                ]
+            )
+        )
+    return wall * 1000, import_time_us(result.stderr)
+
+
+def measure(python: str, name: str, runs: int) -> dict:
+    run_once(python, name)  # warm the page cache and any bytecode
+    samples = [run_once(python, name) for _ in range(runs)]
+    return {
+        "wall_ms": round(statistics.median(wall for wall, _ in samples), 2),
+        "import_ms": round(statistics.median(us for _, us in samples) / 1000, 2),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "-C", str(SCRIPT.parent), "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def last_record(history: Path) -> dict | None:
+    if not history.exists():
+        return None
+    lines = history.read_text(encoding="utf-8").splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark token-summary.py startup and track it over time.",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=10, help="Timed runs per scenario (default 10)"
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help=f"Scenario to run (repeatable; default {', '.join(DEFAULT_SCENARIOS)})",
+    )
+    parser.add_argument(
+        "--python",
+        default=sys.executable,
+        help="Interpreter to benchmark (default: this one)",
+    )
+    parser.add_argument(
+        "--history",
+        type=Path,
+        default=default_history_path(),
+        help="JSONL history file (default $XDG_STATE_HOME/dot-agents/...)",
+    )
+    parser.add_argument(
+        "--no-record",
+        action="store_true",
+        help="Do not append this run to the history",
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=None,
+        help="Exit 1 if any scenario's median import time exceeds this",
+    )
+    args = parser.parse_args()
+
+    if args.runs < 1:
+        parser.error("--runs must be >= 1")
+
+    previous = last_record(args.history)
+    record = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": args.python,
+        "scenarios": {},
+    }
+
+    over_budget = False
+    for name in args.scenario or DEFAULT_SCENARIOS:
+        result = measure(args.python, name, args.runs)
+        record["scenarios"][name] = result
+        delta = ""
+        if previous and name in previous.get("scenarios", {}):
+            before = previous["scenarios"][name]["import_ms"]
+            delta = f" ({result['import_ms'] - before:+.2f} ms imports vs last run)"
+        print(
+            f"{name:<12} wall={result['wall_ms']:.2f}ms "
+            f"imports={result['import_ms']:.2f}ms{delta}"
+        )
+        if args.budget_ms is not None and result["import_ms"] > args.budget_ms:
+            print(
+                f"{name}: import time {result['import_ms']:.2f}ms exceeds "
+                f"budget {args.budget_ms:.2f}ms",
+                file=sys.stderr,
+            )
+            over_budget = True
+
+    if not args.no_record:
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+        with args.history.open("a", encoding="utf-8") as handle:
+            handle.write(json.dumps(record) + "\n")
+
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -4,141 +4,32 @@
 from __future__ import annotations
 
 import argparse
-import re
+import json
+import os
 import sys
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
 
-import yaml
+from agents_catalog import (
+    Agent,
+    CatalogIndex,
+    SearchHit,
+    SearchIndex,
+    Skill,
+    build_tree_content,
+    collect_agents,
+    collect_skills,
+    default_index_path,
+    default_search_index_path,
+    extract_use_when,
+    search_skills,
+)
 from rich.console import Console
 from rich.table import Table
 from rich.tree import Tree
 
 
-@dataclass
-class Skill:
-    name: str
-    description: str
-    path: Path
-
-
-@dataclass
-class Agent:
-    name: str
-    description: str
-    mode: str | None
-    path: Path
-
-
-def parse_yaml_frontmatter(content: str) -> dict | None:
-    """Extract YAML frontmatter from markdown content."""
-    if not content.startswith("---"):
-        return None
-
-    # Find the end of frontmatter
-    match = re.search(r"^---\s*$(.+?)^---\s*$", content, re.MULTILINE | re.DOTALL)
-    if not match:
-        return None
-
-    try:
-        return yaml.safe_load(match.group(1))
-    except yaml.YAMLError:
-        return None
-
-
-def collect_skills(src_path: Path) -> List[Skill]:
-    """Collect all skills from the skills directory."""
-    skills_dir = src_path / "dot-agents" / "skills"
-    if not skills_dir.exists():
-        return []
-
-    skills = []
-    for skill_path in skills_dir.rglob("SKILL.md"):
-        # Skip the AGENTS.md in skills root
-        if skill_path.parent == skills_dir:
-            continue
-
-        content = skill_path.read_text(encoding="utf-8")
-        frontmatter = parse_yaml_frontmatter(content)
-
-        if frontmatter and "name" in frontmatter:
-            skills.append(
-                Skill(
-                    name=frontmatter.get("name", ""),
-                    description=frontmatter.get("description", "")
-                    .replace("\n", " ")
-                    .strip(),
-                    path=skill_path,
-                )
-            )
-
-    return sorted(skills, key=lambda s: s.name)
-
-
-def collect_agents(src_path: Path) -> List[Agent]:
-    """Collect all agents from the agents directory."""
-    agents_dir = src_path / "dot-config" / "opencode" / "agents"
-    if not agents_dir.exists():
-        return []
-
-    agents = []
-    for agent_path in agents_dir.glob("*.md"):
-        content = agent_path.read_text(encoding="utf-8")
-        frontmatter = parse_yaml_frontmatter(content)
-
-        if frontmatter and "description" in frontmatter:
-            name = agent_path.stem
-            agents.append(
-                Agent(
-                    name=name,
-                    description=frontmatter.get("description", "").strip(),
-                    mode=frontmatter.get("mode"),
-                    path=agent_path,
-                )
-            )
-
-    return sorted(agents, key=lambda a: a.name)
-
-
-def format_description(description: str, max_len: int | None = None) -> str:
-    """Clean description for display, optionally truncating."""
-    # Replace multiple spaces and newlines with single space
-    desc = " ".join(description.split())
-    if max_len and len(desc) > max_len:
-        # Find the last space before max_len to break at word boundary
-        trunc = desc[: max_len - 3]
-        last_space = trunc.rfind(" ")
-        if last_space > 0:
-            trunc = trunc[:last_space]
-        return trunc + "..."
-    return desc
-
-
-def extract_use_when(description: str, max_len: int = 100) -> str:
-    """Extract the 'Use when' sentence and truncate to max_len chars at word boundary."""
-    # Clean the description first
-    desc = " ".join(description.split())
-
-    # Find the "Use when" clause
-    match = re.search(r"Use when[^.]*\.", desc, re.IGNORECASE)
-    if match:
-        use_when = match.group(0)
-    else:
-        # Fallback: if no "Use when" found, use the whole description
-        use_when = desc
-
-    # Truncate at max_len to end of word
-    if len(use_when) > max_len:
-        trunc = use_when[:max_len]
-        last_space = trunc.rfind(" ")
-        if last_space > 0:
-            trunc = trunc[:last_space]
-        return trunc + "..."
-
-    return use_when
-
-
 def output_table(skills: List[Skill], agents: List[Agent], console: Console) -> None:
     """Output results in a formatted table."""
     # Agents table
@@ -169,71 +60,6 @@ def output_table(skills: List[Skill], agents: List[Agent], console: Console) ->
         console.print(skill_table)
 
 
-def build_tree_content(
-    skills: List[Skill],
-    agents: List[Agent],
-    show_descriptions: bool = False,
-    use_color: bool = True,
-) -> str:
-    """Build tree content as string, optionally with color codes."""
-    # Plain text tree without color codes
-    lines = ["dot-agents"]
-
-    if agents:
-        lines.append("├── Agents")
-        for i, agent in enumerate(agents):
-            is_last_agent = i == len(agents) - 1 and not skills
-            prefix = "│   └── " if is_last_agent else "│   ├── "
-            mode_str = f" ({agent.mode})" if agent.mode else ""
-            lines.append(f"{prefix}{agent.name}{mode_str}")
-            if show_descriptions:
-                desc = extract_use_when(agent.description)
-                # Indent description under agent
-                desc_prefix = "│       " if is_last_agent else "│   │   "
-                for line in _wrap_text(desc, 60):
-                    lines.append(f"{desc_prefix}{line}")
-
-    if skills:
-        lines.append("└── Skills")
-        for i, skill in enumerate(skills):
-            is_last = i == len(skills) - 1
-            prefix = "    └── " if is_last else "    ├── "
-            lines.append(f"{prefix}{skill.name}")
-            if show_descriptions:
-                desc = extract_use_when(skill.description)
-                desc_prefix = "        " if is_last else "    │   "
-                for line in _wrap_text(desc, 60):
-                    lines.append(f"{desc_prefix}{line}")
-
-    return "\n".join(lines)
-
-
-def _wrap_text(text: str, width: int) -> List[str]:
-    """Wrap text into lines of max width, breaking at word boundaries."""
-    if len(text) <= width:
-        return [text]
-
-    words = text.split()
-    lines = []
-    current_line = []
-    current_len = 0
-
-    for word in words:
-        if current_len + len(word) + (1 if current_line else 0) <= width:
-            current_line.append(word)
-            current_len += len(word) + (1 if current_len > 0 else 0)
-        else:
-            if current_line:
-                lines.append(" ".join(current_line))
-            current_line = [word]
-            current_len = len(word)
-
-    if current_line:
-        lines.append(" ".join(current_line))
-
-    return lines if lines else [text]
-
-
 def output_tree(
     skills: List[Skill],
     agents: List[Agent],
@@ -307,8 +133,6 @@ def output_compact(
 
 def output_json(skills: List[Skill], agents: List[Agent]) -> None:
     """Output as JSON for programmatic use."""
-    import json
-
     data = {
         "agents": [
             {
@@ -329,6 +153,33 @@ def output_json(skills: List[Skill], agents: List[Agent]) -> None:
     console.print(json.dumps(data, indent=2))
 
 
+def output_search(hits: List[SearchHit], console: Console, as_json: bool) -> None:
+    """Output ranked search results."""
+    if as_json:
+        data = [
+            {
+                "name": hit.skill.name,
+                "score": round(hit.score, 4),
+                "description": hit.skill.description,
+                "path": str(hit.skill.path),
+            }
+            for hit in hits
+        ]
+        # Plain print: console.print would soft-wrap long strings
+        print(json.dumps(data, indent=2))
+        return
+
+    table = Table(show_header=True, header_style="bold")
+    table.add_column("Score", style="yellow", justify="right")
+    table.add_column("Name", style="green", min_width=20)
+    table.add_column("Description")
+    for hit in hits:
+        table.add_row(
+            f"{hit.score:.2f}", hit.skill.name, extract_use_when(hit.skill.description)
+        )
+    console.print(table)
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(
         description="List agents and skills from the dot-agents repository.",
@@ -365,8 +216,58 @@ def main() -> int:
         action="store_true",
         help="Output plain text without ANSI color codes",
     )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        default=default_index_path(),
+        help="Frontmatter index file (default $XDG_CACHE_HOME/dot-agents/...)",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Parse every file without reading or writing the index",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=0,
+        help="Worker threads for scanning (0 = auto; 1 = sequential)",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Discard the catalog and search indexes and re-read every file",
+    )
+
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    search_parser = subparsers.add_parser(
+        "search",
+        help="Rank skills for a query with BM25",
+        description=(
+            "Rank skills by BM25 over their name, description, 'Use when' "
+            "sentence, SKILL.md headings and references/*.md."
+        ),
+    )
+    search_parser.add_argument("query", nargs="+", help="Search terms")
+    search_parser.add_argument(
+        "--limit",
+        "-n",
+        type=int,
+        default=10,
+        help="Maximum number of results (default: 10)",
+    )
+    search_parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Output results as JSON",
+    )
 
     args = parser.parse_args()
+    if args.jobs < 0:
+        parser.error("--jobs must be >= 0")
+    if args.command == "search" and args.limit < 1:
+        parser.error("--limit must be >= 1")
 
     # Resolve path relative to script location or cwd
     src_path = args.src
@@ -385,14 +286,40 @@ def main() -> int:
 
     agents = []
     skills = []
+    index = None if args.no_index else CatalogIndex(args.index, args.rebuild)
+    # Scanning is I/O bound, so auto sizes the pool like ThreadPoolExecutor
+    jobs = args.jobs or min(32, (os.cpu_count() or 1) + 4)
+    pool = ThreadPoolExecutor(jobs) if jobs > 1 else None
+
+    console = Console(file=sys.stdout)
 
-    if not args.skills_only:
-        agents = collect_agents(src_path)
+    if args.command == "search":
+        search_index = SearchIndex(default_search_index_path(), args.rebuild)
+        try:
+            hits = search_skills(
+                src_path, " ".join(args.query), args.limit, search_index, index, pool
+            )
+        finally:
+            search_index.close()
+            if pool is not None:
+                pool.shutdown()
+        if index is not None:
+            index.save()
+        output_search(hits, console, args.json)
+        return 0
 
-    if not args.agents_only:
-        skills = collect_skills(src_path)
+    try:
+        if not args.skills_only:
+            agents = collect_agents(src_path, index, pool)
 
-    console = Console(file=sys.stdout)
+        if not args.agents_only:
+            skills = collect_skills(src_path, index, pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if index is not None:
+        index.save()
 
     if args.format == "json":
         output_json(skills, agents)
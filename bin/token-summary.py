@@ -2,46 +2,280 @@
 
 from __future__ import annotations
 
+# Heavy modules (tiktoken, rich, sqlite3, concurrent.futures, socket) are
+# imported on the code paths that need them, and records are NamedTuples
+# rather than dataclasses (which pull in inspect), so --help, usage errors
+# and --connect clients start fast. Track with bin/bench-startup.py.
 import argparse
+import bisect
+import fnmatch
+import heapq
+import io
 import json
+import math
+import mmap
 import os
+import re
 import stat
 import sys
-from dataclasses import dataclass
-from typing import Iterable, List
+import threading
+import time
+from itertools import accumulate, chain
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    TypeVar,
+)
 
-import tiktoken
-from rich.console import Console
+if TYPE_CHECKING:
+    import zipfile
+    from concurrent.futures import Future
+
+    import tiktoken
+    from rich.console import Console
 
 DEFAULT_MAX_BYTES = 1_048_576
 DEFAULT_ENCODING = "cl100k_base"
+TIKTOKEN_BASE_URL = "https://openaipublic.blob.core.windows.net/encodings/"
+ENDOFTEXT = "<|endoftext|>"
+ENDOFPROMPT = "<|endofprompt|>"
+FIM_PREFIX = "<|fim_prefix|>"
+FIM_MIDDLE = "<|fim_middle|>"
+FIM_SUFFIX = "<|fim_suffix|>"
+R50K_PAT_STR = (
+    r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}++| ?\p{N}++| ?[^\s\p{L}\p{N}]++|"""
+    r"""\s++$|\s+(?!\S)|\s"""
+)
+CL100K_PAT_STR = (
+    r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+|"""
+    r""" ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+)
+O200K_PAT_STR = "|".join(
+    [
+        r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*"""
+        r"""[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+        r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+"""
+        r"""[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+        r"""\p{N}{1,3}""",
+        r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+        r"""\s*[\r\n]+""",
+        r"""\s+(?!\S)""",
+        r"""\s+""",
+    ]
+)
+# Name -> (pattern, special tokens, sha256 of the published rank file), as
+# in tiktoken_ext.openai_public; lets local rank files load without a network.
+TIKTOKEN_ENCODINGS: dict[str, tuple[str, dict[str, int], str]] = {
+    "r50k_base": (
+        R50K_PAT_STR,
+        {ENDOFTEXT: 50256},
+        "306cd27f03c1a714eca7108e03d66b7dc042abe8c258b44c199a7ed9838dd930",
+    ),
+    "p50k_base": (
+        R50K_PAT_STR,
+        {ENDOFTEXT: 50256},
+        "94b5ca7dff4d00767bc256fdd1b27e5b17361d7b8a5f968547f9f23eb70d2069",
+    ),
+    "cl100k_base": (
+        CL100K_PAT_STR,
+        {
+            ENDOFTEXT: 100257,
+            FIM_PREFIX: 100258,
+            FIM_MIDDLE: 100259,
+            FIM_SUFFIX: 100260,
+            ENDOFPROMPT: 100276,
+        },
+        "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7",
+    ),
+    "o200k_base": (
+        O200K_PAT_STR,
+        {ENDOFTEXT: 199999, ENDOFPROMPT: 200018},
+        "446a9538cb6c348e3516120d7c08b09f57c36495e2acfffe59a5bf8b0cfb1a2d",
+    ),
+}
 BINARY_PREFIX_BYTES = 32 * 1024
+MMAP_MIN_BYTES = 256 * 1024
+BATCH_MAX_ITEMS = 64
+BATCH_MAX_BYTES = 4 * 1024 * 1024
+WINDOW_PER_JOB = 4
+INTAKE_MAX_ITEMS = 4096
+DEFAULT_CACHE_MAX_ENTRIES = 500_000
+EXIT_OVER_BUDGET = 3
+# --top lists at most this many skipped inputs; the rest are counted by reason.
+TOP_MAX_SKIPS = 100
+CACHE_DIGEST_BYTES = 16
+STREAM_CHUNK_BYTES = 1024 * 1024
+STREAM_MAX_CARRY_BYTES = 4 * STREAM_CHUNK_BYTES
+STREAM_SPLIT_SEARCH_BYTES = 64 * 1024
+# --approx: sampling unit size, units always counted per stratum, and z for
+# the reported 95% confidence interval.
+APPROX_CHUNK_BYTES = 64 * 1024
+APPROX_MIN_UNITS = 30
+APPROX_DEFAULT_FRACTION = 0.05
+APPROX_Z = 1.959964
+# --group-by quantile sketches: relative accuracy of reported percentiles.
+SKETCH_ACCURACY = 0.01
+# --stdin auto decides from at most this much of stdin, then streams the rest.
+STDIN_SAMPLE_LINES = 256
+STDIN_SAMPLE_BYTES = 64 * 1024
+WATCH_DEBOUNCE_SECONDS = 0.05
+WATCH_POLL_SECONDS = 0.5
+# inotify(7) event bits.
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_STRUCTURAL = (
+    IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+# Positions where the tiktoken pre-tokenizer patterns (cl100k/o200k) always
+# end a piece: after a newline run followed by a letter, and after a letter
+# followed by " <letter>". Encoding each side separately then yields the same
+# tokens as encoding the whole text.
+SAFE_SPLIT_RE = re.compile(rb"\n(?=[A-Za-z])|[A-Za-z](?= [A-Za-z])")
+
+MARKDOWN_SUFFIXES = (".md", ".markdown")
+# Suffix -> (container, compression); longer suffixes first so ".tar.gz" wins.
+ARCHIVE_SUFFIXES = (
+    (".tar.gz", ("tar", "gz")),
+    (".tar.bz2", ("tar", "bz2")),
+    (".tar.xz", ("tar", "xz")),
+    (".tar.zst", ("tar", "zst")),
+    (".tgz", ("tar", "gz")),
+    (".tbz2", ("tar", "bz2")),
+    (".txz", ("tar", "xz")),
+    (".tzst", ("tar", "zst")),
+    (".tar", ("tar", None)),
+    (".zip", ("zip", None)),
+    (".skill", ("zip", None)),
+    (".gz", (None, "gz")),
+    (".bz2", (None, "bz2")),
+    (".xz", (None, "xz")),
+    (".zst", (None, "zst")),
+)
+ARCHIVE_SEPARATOR = "!"
+PREAMBLE_HEADING = "(preamble)"
+ATX_HEADING_RE = re.compile(
+    rb"^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*\r?\n?$"
+)
+FENCE_RE = re.compile(rb"^ {0,3}(`{3,}|~{3,})")
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
-@dataclass
-class InputItem:
+class InputItem(NamedTuple):
     id: str
-    kind: str  # "path" | "text"
+    kind: str  # "path" | "text" | "stream"
     text: str | None = None
     path: str | None = None
     bytes_len: int | None = None
+    handle: BinaryIO | None = None  # for "stream"; defaults to stdin
 
 
-@dataclass
-class ResultItem:
+class Section(NamedTuple):
+    heading: str  # e.g. "## References > ### Async"
+    tokens: int
+    start: int  # byte offsets into the file
+    end: int
+
+
+class ResultItem(NamedTuple):
     id: str
     status: str  # "ok" | "skipped"
     tokens: int | None = None
     bytes_len: int | None = None
     reason: str | None = None
+    # Counts for the second and later --encoding names, in order.
+    extra_tokens: tuple[int, ...] = ()
+    sections: tuple[Section, ...] = ()
+    digest: bytes | None = None
+    # Id of the first input with identical content (set in input order).
+    duplicate_of: str | None = None
+    # --git-diff: git status letter and the counts at the base revision.
+    change: str | None = None
+    before: tuple[int, ...] | None = None
+
+
+class SampleUnit(NamedTuple):
+    path: str
+    stratum: str
+    offset: int
+    size: int
+    whole: bool  # the whole file (small files and archives), not a chunk
+
+
+class StreamedBlob(NamedTuple):
+    """A blob over ``--max-bytes`` counted while it streamed from git."""
+
+    counts: List[int] | None  # None when the blob is binary
+    bytes_len: int
+
+
+class BlobChange(NamedTuple):
+    path: str
+    status: str
+    old: bytes | StreamedBlob | None  # None when the path has no blob that side
+    new: bytes | StreamedBlob | None
+    too_large: bool = False
+
+
+class CountContext(NamedTuple):
+    encoders: List[tiktoken.Encoding]
+    max_bytes: int
+    cache: TokenCache | None = None
+    stream: bool = False
+    by_section: bool = False
+    dedup: ContentIndex | None = None
+    archives: bool = True
+
+
+def ok_result(
+    item_id: str,
+    counts: List[int],
+    bytes_len: int,
+    sections: tuple[Section, ...] = (),
+    digest: bytes | None = None,
+) -> ResultItem:
+    return ResultItem(
+        id=item_id,
+        status="ok",
+        tokens=counts[0],
+        bytes_len=bytes_len,
+        extra_tokens=tuple(counts[1:]),
+        sections=sections,
+        digest=digest,
+    )
 
 
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Estimate token counts for files or stdin using tiktoken.",
     )
-    parser.add_argument("paths", nargs="*", help="File paths (use fd ... -X).")
-    parser.add_argument("--json", action="store_true", help="Emit JSON output.")
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Files or directories; directories are walked honoring .gitignore.",
+    )
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true", help="Emit JSON output.")
+    output.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Emit one JSON line per item as it completes, then a totals line.",
+    )
     parser.add_argument(
         "--max-bytes",
         type=int,
@@ -51,7 +285,21 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--encoding",
         default=DEFAULT_ENCODING,
-        help=f"Tokenizer encoding (default {DEFAULT_ENCODING}).",
+        help=(
+            f"Tokenizer encoding, or a comma-separated list counted in one pass "
+            f"(default {DEFAULT_ENCODING}). Entries may also be paths to a "
+            f".tiktoken rank file or a HuggingFace tokenizer.json."
+        ),
+    )
+    parser.add_argument(
+        "--tokenizer-dir",
+        default=None,
+        metavar="DIR",
+        help=(
+            "Directory of local tokenizers: NAME.tiktoken rank files and "
+            "NAME.json or NAME/tokenizer.json (default $TOKEN_SUMMARY_TOKENIZERS "
+            "or $XDG_DATA_HOME/dot-agents/tokenizers)."
+        ),
     )
     parser.add_argument(
         "--stdin",
@@ -62,6 +310,170 @@ def build_parser() -> argparse.ArgumentParser:
             "ignore when args present."
         ),
     )
+    parser.add_argument(
+        "--hidden",
+        action="store_true",
+        help="Walk hidden files and directories (names starting with '.').",
+    )
+    parser.add_argument(
+        "--no-ignore",
+        action="store_true",
+        help="Do not honor .gitignore files when walking directories.",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Only count walked files whose name or relative path matches GLOB.",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Skip walked files and directories matching GLOB (repeatable).",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=(
+            "Tokenize files over --max-bytes and stdin text in bounded chunks "
+            "instead of skipping or buffering them."
+        ),
+    )
+    parser.add_argument(
+        "--by-section",
+        action="store_true",
+        help="Break markdown files down by ATX heading path (first encoding).",
+    )
+    parser.add_argument(
+        "--git-diff",
+        metavar="A..B",
+        help=(
+            "Count token deltas for files changed between two revisions, read "
+            "from git objects (no checkout). Paths limit the diff."
+        ),
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "After the first count, recount files as they change and print "
+            "updated counts and totals until interrupted."
+        ),
+    )
+    parser.add_argument(
+        "--no-archives",
+        action="store_true",
+        help=(
+            "Treat zip/.skill, tar and compressed files as opaque (binary) "
+            "instead of counting their members as ARCHIVE!MEMBER."
+        ),
+    )
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="Do not hash content to detect and share counts for duplicate files.",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Worker threads for reading and encoding (0 = all cores; default 1).",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the persistent token cache.",
+    )
+    parser.add_argument(
+        "--cache-path",
+        default=None,
+        help=(
+            "Token cache database "
+            "(default $XDG_CACHE_HOME/dot-agents/token-summary.sqlite3)."
+        ),
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=DEFAULT_CACHE_MAX_ENTRIES,
+        help=(
+            "Evict least recently used cache entries beyond this "
+            f"(default {DEFAULT_CACHE_MAX_ENTRIES})."
+        ),
+    )
+    parser.add_argument(
+        "--approx",
+        action="store_true",
+        help=(
+            "Estimate totals from a stratified sample of files and chunks, "
+            "with a 95%% confidence interval and the speedup over an exact count."
+        ),
+    )
+    parser.add_argument(
+        "--sample-fraction",
+        type=float,
+        default=APPROX_DEFAULT_FRACTION,
+        metavar="F",
+        help=(
+            f"Fraction of units to sample per stratum with --approx "
+            f"(default {APPROX_DEFAULT_FRACTION}; at least {APPROX_MIN_UNITS})."
+        ),
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed for --approx sampling (default 0, reproducible).",
+    )
+    parser.add_argument(
+        "--group-by",
+        default=None,
+        metavar="KEY",
+        help=(
+            "Aggregate instead of listing files: ext, dir (top-level directory) "
+            "or depth=N (first N directories). Reports files, tokens, p50, p95 "
+            "and max per group in constant memory."
+        ),
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=None,
+        metavar="K",
+        help="List only the K heaviest files (totals still cover every input).",
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            f"Stop once the running token total (the delta with --git-diff) "
+            f"exceeds N and exit {EXIT_OVER_BUDGET}."
+        ),
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run a server on --socket that keeps encoders loaded between calls.",
+    )
+    parser.add_argument(
+        "--connect",
+        action="store_true",
+        help="Run on the --socket server if one is listening, else locally.",
+    )
+    parser.add_argument(
+        "--socket",
+        default=None,
+        help=(
+            "Server socket path (default $TOKEN_SUMMARY_SOCKET or "
+            "$XDG_RUNTIME_DIR/dot-agents-token-summary.sock)."
+        ),
+    )
     parser.add_argument(
         "--fail-on-skip",
         action="store_true",
@@ -70,8 +482,153 @@ def build_parser() -> argparse.ArgumentParser:
     return parser
 
 
-def parse_args(parser: argparse.ArgumentParser) -> argparse.Namespace:
-    return parser.parse_args()
+class TokenCache:
+    """SQLite cache of token counts keyed by (content digest, encoding name).
+
+    Lookups are shared across worker threads behind one lock. Inserts and
+    recency updates are buffered and written in a single transaction on
+    ``flush()`` (or ``close()``), which also trims the table to
+    ``max_entries`` by LRU.
+    """
+
+    def __init__(self, path: str, max_entries: int) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._inserts: dict[tuple[bytes, str], int] = {}
+        self._touched: set[tuple[bytes, str]] = set()
+        import sqlite3
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            " digest BLOB NOT NULL, encoding TEXT NOT NULL,"
+            " tokens INTEGER NOT NULL, used REAL NOT NULL,"
+            " PRIMARY KEY (digest, encoding)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tokens_used ON tokens (used)")
+        self._conn.commit()
+
+    def get(self, digest: bytes, encoding: str) -> int | None:
+        key = (digest, encoding)
+        with self._lock:
+            tokens = self._inserts.get(key)
+            if tokens is None:
+                row = self._conn.execute(
+                    "SELECT tokens FROM tokens WHERE digest = ? AND encoding = ?", key
+                ).fetchone()
+                tokens = row[0] if row else None
+            if tokens is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._touched.add(key)
+            return tokens
+
+    def put(self, digest: bytes, encoding: str, tokens: int) -> None:
+        with self._lock:
+            self._inserts[(digest, encoding)] = tokens
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
+
+    def flush(self) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+                [(d, e, n, now) for (d, e), n in self._inserts.items()],
+            )
+            self._conn.executemany(
+                "UPDATE tokens SET used = ? WHERE digest = ? AND encoding = ?",
+                [(now, d, e) for d, e in self._touched],
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM tokens").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM tokens WHERE (digest, encoding) IN ("
+                    " SELECT digest, encoding FROM tokens ORDER BY used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._inserts.clear()
+            self._touched.clear()
+
+
+def default_cache_path() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "dot-agents", "token-summary.sqlite3")
+
+
+def open_cache(args: argparse.Namespace) -> TokenCache | None:
+    if args.no_cache:
+        return None
+    import sqlite3
+
+    path = args.cache_path or default_cache_path()
+    try:
+        return TokenCache(path, args.cache_max_entries)
+    except (OSError, sqlite3.Error) as exc:
+        sys.stderr.write(f"Token cache disabled ({path}): {exc}\n")
+        return None
+
+
+class ContentIndex:
+    """Digests claimed by workers so identical content is encoded only once.
+
+    The first worker to claim a digest encodes it; later claimants wait for
+    its counts. Which input is reported as the original is decided later, in
+    input order, by ``mark_duplicates``. Only in-flight digests hold an
+    Event; finished ones keep just a tuple of counts, so memory per unique
+    input stays small on million-path runs.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts: dict[bytes, tuple[int, ...]] = {}
+        self._pending: dict[bytes, threading.Event] = {}
+
+    def claim(self, digest: bytes) -> tuple[int, ...] | threading.Event | None:
+        """Return known counts, an Event to wait on, or None to become owner."""
+        with self._lock:
+            counts = self._counts.get(digest)
+            if counts is not None:
+                return counts
+            done = self._pending.get(digest)
+            if done is not None:
+                return done
+            self._pending[digest] = threading.Event()
+            return None
+
+    def finish(self, digest: bytes, counts: List[int] | None) -> None:
+        """Publish the owner's counts (None if it failed) and wake waiters."""
+        with self._lock:
+            if counts is not None:
+                self._counts[digest] = tuple(counts)
+            done = self._pending.pop(digest)
+        done.set()
+
+
+def content_digest(data: bytes | mmap.mmap) -> bytes:
+    import hashlib
+
+    return hashlib.blake2b(data, digest_size=CACHE_DIGEST_BYTES).digest()
+
+
+def parse_args(
+    parser: argparse.ArgumentParser, argv: List[str] | None = None
+) -> argparse.Namespace:
+    return parser.parse_args(argv)
+
+
+def parse_encodings(value: str) -> List[str]:
+    return [name.strip() for name in value.split(",") if name.strip()]
 
 
 def choose_stdin_mode(args: argparse.Namespace) -> str:
@@ -102,213 +659,2636 @@ def detect_stdin_mode_auto(text: str) -> str:
     return "paths" if ratio >= 0.8 else "text"
 
 
-def parse_stdin(mode: str, stdin_bytes: bytes) -> List[InputItem]:
-    text = stdin_bytes.decode("utf-8", errors="replace")
+def read_stdin_sample(handle: BinaryIO) -> tuple[bytes, bool]:
+    """Read the head of ``handle`` for mode detection; return ``(head, eof)``.
+
+    Stops after ``STDIN_SAMPLE_LINES`` lines or ``STDIN_SAMPLE_BYTES``, so a
+    million-line path list costs a bounded read and a few hundred stats.
+    """
+    chunks: List[bytes] = []
+    size = 0
+    lines = 0
+    while size < STDIN_SAMPLE_BYTES and lines < STDIN_SAMPLE_LINES:
+        chunk = handle.read1(STDIN_SAMPLE_BYTES - size)
+        if not chunk:
+            return b"".join(chunks), True
+        chunks.append(chunk)
+        size += len(chunk)
+        lines += chunk.count(b"\n")
+    return b"".join(chunks), False
+
+
+class ReplayReader(io.RawIOBase):
+    """Bytes already read from ``handle``, followed by the rest of it."""
+
+    def __init__(self, head: bytes, handle: BinaryIO) -> None:
+        self._head = memoryview(head)
+        self._handle = handle
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:
+        if self._head:
+            size = min(len(buffer), len(self._head))
+            buffer[:size] = self._head[:size]
+            self._head = self._head[size:]
+            return size
+        data = self._handle.read1(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def iter_stdin_paths(head: bytes, handle: BinaryIO) -> Iterator[InputItem]:
+    """Yield path items line by line as stdin delivers them."""
+    lines = head.split(b"\n")
+    if lines[-1]:
+        # Finish the sample's partial last line; a complete sample must not
+        # block here waiting for the next line to arrive
+        lines[-1] += handle.readline()
+    for raw in chain(lines, handle):
+        line = raw.decode("utf-8", errors="replace").strip()
+        if line:
+            yield InputItem(id=line, kind="path", path=line)
+
+
+def stdin_inputs(mode: str, handle: BinaryIO, stream: bool) -> Iterator[InputItem]:
     if mode == "ignore":
-        return []
-    if mode == "text":
-        return [
-            InputItem(id="<stdin>", kind="text", text=text, bytes_len=len(stdin_bytes))
-        ]
-    if mode == "paths":
-        return [
-            InputItem(id=line, kind="path", path=line) for line in stdin_as_paths(text)
-        ]
+        return
+    head, eof = b"", False
     if mode == "auto":
-        auto_mode = detect_stdin_mode_auto(text)
-        return parse_stdin(auto_mode, stdin_bytes)
-    raise ValueError(f"Unknown stdin mode: {mode}")
+        head, eof = read_stdin_sample(handle)
+        sample = head if eof else head[: head.rfind(b"\n") + 1]
+        mode = detect_stdin_mode_auto(sample.decode("utf-8", errors="replace"))
+    if mode == "paths":
+        yield from iter_stdin_paths(head, handle)
+    elif mode == "text" and stream:
+        rest = handle if not head else io.BufferedReader(ReplayReader(head, handle))
+        yield InputItem(id="<stdin>", kind="stream", handle=rest)
+    elif mode == "text":
+        data = head if eof else head + handle.read()
+        yield InputItem(
+            id="<stdin>",
+            kind="text",
+            text=data.decode("utf-8", errors="replace"),
+            bytes_len=len(data),
+        )
+    else:
+        raise ValueError(f"Unknown stdin mode: {mode}")
 
 
-def is_binary(path: str, max_bytes: int) -> bool:
-    read_len = min(BINARY_PREFIX_BYTES, max_bytes)
-    try:
-        with open(path, "rb") as handle:
-            chunk = handle.read(read_len)
-    except OSError:
-        return False
-    return b"\x00" in chunk
+def count_text(text: str, encoders: List[tiktoken.Encoding]) -> List[int]:
+    return [len(encoder.encode(text, disallowed_special=())) for encoder in encoders]
+
 
+def count_bytes(
+    data: bytes | mmap.mmap, ctx: CountContext
+) -> tuple[List[int], bytes | None]:
+    """Return ``(counts, digest)`` for ``data``, decoding at most once.
 
-def process_path(path: str, max_bytes: int, encoder: tiktoken.Encoding) -> ResultItem:
+    ``digest`` is None when dedup is off; it is then only used as a cache key.
+    """
+    if ctx.cache is None and ctx.dedup is None:
+        return count_text(str(data, "utf-8", "replace"), ctx.encoders), None
+    digest = content_digest(data)
+    if ctx.dedup is None:
+        return count_uncached(data, digest, ctx), None
+
+    while True:
+        claim = ctx.dedup.claim(digest)
+        if claim is None:
+            break
+        if isinstance(claim, tuple):
+            return list(claim), digest
+        # Another worker owns this digest; if it fails, claim it again.
+        claim.wait()
+    counts = None
     try:
-        st = os.stat(path)
-    except OSError:
-        return ResultItem(id=path, status="skipped", reason="not_a_file")
+        counts = count_uncached(data, digest, ctx)
+    finally:
+        ctx.dedup.finish(digest, counts)
+    return counts, digest
+
+
+def count_uncached(
+    data: bytes | mmap.mmap, digest: bytes, ctx: CountContext
+) -> List[int]:
+    if ctx.cache is None:
+        return count_text(str(data, "utf-8", "replace"), ctx.encoders)
+    text: str | None = None
+    counts: List[int] = []
+    for encoder in ctx.encoders:
+        tokens = ctx.cache.get(digest, encoder.name)
+        if tokens is None:
+            if text is None:
+                text = str(data, "utf-8", "replace")
+            tokens = len(encoder.encode(text, disallowed_special=()))
+            ctx.cache.put(digest, encoder.name, tokens)
+        counts.append(tokens)
+    return counts
+
+
+def safe_split_point(buf: bytes) -> int | None:
+    start = max(0, len(buf) - STREAM_SPLIT_SEARCH_BYTES)
+    cut = None
+    for match in SAFE_SPLIT_RE.finditer(buf, start):
+        cut = match.end()
+    return cut
+
+
+def utf8_boundary(buf: bytes, cut: int) -> int:
+    while cut > 0 and (buf[cut] & 0xC0) == 0x80:
+        cut -= 1
+    return cut
+
+
+def iter_safe_chunks(handle: BinaryIO, chunk_bytes: int) -> Iterator[bytes]:
+    """Yield pieces of ``handle`` split only at pre-tokenizer-safe points.
+
+    Text without a safe point is carried forward up to
+    ``STREAM_MAX_CARRY_BYTES`` and then cut at a UTF-8 boundary, which may
+    shift the count by a token or two but keeps memory bounded.
+    """
+    carry = b""
+    while True:
+        block = handle.read(chunk_bytes)
+        if not block:
+            if carry:
+                yield carry
+            return
+        buf = carry + block
+        cut = safe_split_point(buf)
+        if cut is None:
+            if len(buf) < STREAM_MAX_CARRY_BYTES:
+                carry = buf
+                continue
+            cut = utf8_boundary(buf, len(buf) - 1)
+        yield buf[:cut]
+        carry = buf[cut:]
+
+
+def count_stream(
+    handle: BinaryIO, encoders: List[tiktoken.Encoding], digest: bool = False
+) -> tuple[List[int] | None, int, bytes | None]:
+    """Return ``(counts, bytes, digest)`` for a stream.
+
+    counts is None if the stream is binary; digest is only computed on request.
+    """
+    import hashlib
+
+    hasher = hashlib.blake2b(digest_size=CACHE_DIGEST_BYTES) if digest else None
+    counts = [0] * len(encoders)
+    bytes_len = 0
+    for piece in iter_safe_chunks(handle, STREAM_CHUNK_BYTES):
+        if bytes_len == 0 and b"\x00" in piece[:BINARY_PREFIX_BYTES]:
+            return None, len(piece), None
+        if hasher is not None:
+            hasher.update(piece)
+        text = piece.decode("utf-8", errors="replace")
+        for index, encoder in enumerate(encoders):
+            counts[index] += len(encoder.encode(text, disallowed_special=()))
+        bytes_len += len(piece)
+    return counts, bytes_len, hasher.digest() if hasher is not None else None
+
+
+def read_fd(fd: int, size: int) -> bytes | mmap.mmap:
+    """Return the first ``size`` bytes of ``fd`` as one buffer."""
+    if size >= MMAP_MIN_BYTES:
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = os.read(fd, remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def markdown_headings(data: bytes) -> List[tuple[int, str]]:
+    """Return ``(byte offset, heading path)`` for each ATX heading outside fences."""
+    headings: List[tuple[int, str]] = []
+    stack: List[tuple[int, str]] = []
+    fence: bytes | None = None
+    offset = 0
+    for line in data.splitlines(keepends=True):
+        fence_match = FENCE_RE.match(line)
+        if fence_match:
+            marker = fence_match.group(1)
+            if fence is None:
+                fence = marker
+            elif marker[:1] == fence[:1] and len(marker) >= len(fence):
+                fence = None
+        elif fence is None:
+            match = ATX_HEADING_RE.match(line)
+            if match:
+                level = len(match.group(1))
+                title = (match.group(2) or b"").decode("utf-8", errors="replace")
+                while stack and stack[-1][0] >= level:
+                    stack.pop()
+                stack.append((level, f"{'#' * level} {title}".rstrip()))
+                headings.append((offset, " > ".join(label for _, label in stack)))
+        offset += len(line)
+    return headings
+
+
+def count_sections(
+    text: str, encoder: tiktoken.Encoding
+) -> tuple[int, tuple[Section, ...]]:
+    """Encode once and attribute each token to the section its bytes start in.
+
+    Offsets are into ``text`` as UTF-8, which matches the file unless it held
+    invalid UTF-8 (replaced while decoding).
+    """
+    data = text.encode("utf-8")
+    tokens = encoder.encode(text, disallowed_special=())
+    starts = list(
+        accumulate((len(b) for b in encoder.decode_tokens_bytes(tokens)), initial=0)
+    )
+    headings = markdown_headings(data)
+    if not headings or headings[0][0] > 0:
+        headings.insert(0, (0, PREAMBLE_HEADING))
+    sections = []
+    for index, (start, heading) in enumerate(headings):
+        end = headings[index + 1][0] if index + 1 < len(headings) else len(data)
+        first = bisect.bisect_left(starts, start, 0, len(tokens))
+        last = bisect.bisect_left(starts, end, 0, len(tokens))
+        if end > start:
+            sections.append(Section(heading, last - first, start, end))
+    return len(tokens), tuple(sections)
 
-    if not stat.S_ISREG(st.st_mode):
-        return ResultItem(id=path, status="skipped", reason="not_a_file")
 
-    if st.st_size > max_bytes:
-        return ResultItem(id=path, status="skipped", reason="too_large")
+def is_markdown(path: str) -> bool:
+    return path.lower().endswith(MARKDOWN_SUFFIXES)
 
-    if is_binary(path, max_bytes):
-        return ResultItem(id=path, status="skipped", reason="binary")
 
+def process_path(path: str, ctx: CountContext) -> ResultItem:
+    """Count one file through a single open: fstat, sniff, decode one buffer.
+
+    ``O_NONBLOCK`` keeps FIFOs from blocking the open; ``fstat`` then
+    rejects them along with directories and devices.
+    """
     try:
-        with open(path, "rb") as handle:
-            data = handle.read(max_bytes)
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_NONBLOCK", 0))
     except OSError:
         return ResultItem(id=path, status="skipped", reason="not_a_file")
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            return ResultItem(id=path, status="skipped", reason="not_a_file")
+        if st.st_size > ctx.max_bytes:
+            if not ctx.stream:
+                return ResultItem(id=path, status="skipped", reason="too_large")
+            with os.fdopen(fd, "rb", closefd=False) as handle:
+                return process_stream(path, handle, ctx)
 
-    text = data.decode("utf-8", errors="replace")
-    tokens = len(encoder.encode(text))
-    return ResultItem(
-        id=path,
-        status="ok",
-        tokens=tokens,
-        bytes_len=len(data),
-    )
+        data = read_fd(fd, st.st_size)
+        try:
+            if data.find(b"\x00", 0, BINARY_PREFIX_BYTES) != -1:
+                return ResultItem(id=path, status="skipped", reason="binary")
+            if ctx.by_section and is_markdown(path):
+                text = str(data, "utf-8", "replace")
+                tokens, sections = count_sections(text, ctx.encoders[0])
+                counts = [tokens, *count_text(text, ctx.encoders[1:])]
+                digest = content_digest(data) if ctx.dedup is not None else None
+                return ok_result(path, counts, len(data), sections, digest)
+            counts, digest = count_bytes(data, ctx)
+            return ok_result(path, counts, len(data), digest=digest)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    except (OSError, ValueError):
+        return ResultItem(id=path, status="skipped", reason="not_a_file")
+    finally:
+        os.close(fd)
 
 
-def process_text(item: InputItem, encoder: tiktoken.Encoding) -> ResultItem:
-    text = item.text or ""
-    tokens = len(encoder.encode(text))
-    return ResultItem(
-        id=item.id,
-        status="ok",
-        tokens=tokens,
-        bytes_len=item.bytes_len
-        if item.bytes_len is not None
-        else len(text.encode("utf-8")),
-    )
+def archive_format(path: str) -> tuple[str | None, str | None] | None:
+    """Return ``(container, compression)`` for archive suffixes, else None."""
+    name = path.lower()
+    for suffix, archive in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            return archive
+    return None
 
 
-def collect_inputs(args: argparse.Namespace) -> List[InputItem]:
-    stdin_bytes: bytes | None = None
+def archive_source(item_id: str) -> str:
+    """Map an ``archive!member`` id back to the archive path."""
+    head, sep, _ = item_id.partition(ARCHIVE_SEPARATOR)
+    return head if sep and archive_format(head) else item_id
 
-    def ensure_stdin() -> bytes:
-        nonlocal stdin_bytes
-        if stdin_bytes is None:
-            stdin_bytes = read_stdin_bytes()
-        return stdin_bytes
-
-    inputs: List[InputItem] = []
-    if args.paths:
-        for path in args.paths:
-            if path == "-":
-                data = ensure_stdin()
-                inputs.append(
-                    InputItem(
-                        id="<stdin>",
-                        kind="text",
-                        text=data.decode("utf-8", errors="replace"),
-                        bytes_len=len(data),
-                    )
-                )
-            else:
-                inputs.append(InputItem(id=path, kind="path", path=path))
-
-        stdin_mode = choose_stdin_mode(args)
-        if stdin_mode != "ignore" and "-" not in args.paths and not sys.stdin.isatty():
-            inputs.extend(parse_stdin(stdin_mode, ensure_stdin()))
-        return inputs
-
-    if sys.stdin.isatty():
-        return []
-
-    stdin_mode = choose_stdin_mode(args)
-    inputs.extend(parse_stdin(stdin_mode, ensure_stdin()))
-    return inputs
-
-
-def summarize(results: Iterable[ResultItem]) -> dict:
-    total_tokens = sum(item.tokens or 0 for item in results if item.status == "ok")
-    ok_count = sum(1 for item in results if item.status == "ok")
-    skipped_count = sum(1 for item in results if item.status == "skipped")
-    return {
-        "tokens": total_tokens,
-        "ok": ok_count,
-        "skipped": skipped_count,
-        "inputs": ok_count + skipped_count,
-    }
 
+def open_decompressed(handle: BinaryIO, compression: str) -> BinaryIO:
+    if compression == "gz":
+        import gzip
 
-def emit_human(
-    results: List[ResultItem],
-    totals: dict,
-    out_console: Console,
-    err_console: Console,
-) -> None:
-    for item in results:
-        if item.status == "ok":
-            out_console.print(
-                f"{item.id} tokens={item.tokens} bytes={item.bytes_len}",
-                highlight=False,
-            )
+        return gzip.GzipFile(fileobj=handle)
+    if compression == "bz2":
+        import bz2
 
-    out_console.print(
-        f"total tokens={totals['tokens']} ok={totals['ok']} skipped={totals['skipped']}",
-        highlight=False,
-    )
+        return bz2.BZ2File(handle)
+    if compression == "xz":
+        import lzma
 
-    for item in results:
-        if item.status == "skipped":
-            hint = " (hint: use fd)" if item.reason == "not_a_file" else ""
-            err_console.print(
-                f"SKIP {item.id} reason={item.reason}{hint}", highlight=False
-            )
+        return lzma.LZMAFile(handle)
+    try:
+        from compression import zstd  # Python 3.14+
+    except ImportError:
+        raise LookupError("zstd needs Python 3.14") from None
+    return zstd.ZstdFile(handle)
 
 
-def emit_json(
-    results: List[ResultItem],
-    totals: dict,
-    encoding: str,
-    max_bytes: int,
-) -> None:
-    payload = {
-        "encoding": encoding,
-        "max_bytes": max_bytes,
-        "items": [
-            {
-                "id": item.id,
-                "status": item.status,
-                **({"tokens": item.tokens} if item.tokens is not None else {}),
-                **({"bytes": item.bytes_len} if item.bytes_len is not None else {}),
-                **({"reason": item.reason} if item.reason else {}),
-            }
-            for item in results
-        ],
-        "total": totals,
-    }
-    sys.stdout.write(json.dumps(payload, indent=2) + "\n")
+def process_member(
+    item_id: str, handle: BinaryIO, size: int | None, ctx: CountContext
+) -> ResultItem:
+    """Count one decompressed stream; ``size`` is None when it is unknown."""
+    if size is None or size > ctx.max_bytes:
+        if ctx.stream:
+            return process_stream(item_id, handle, ctx)
+        if size is not None:
+            return ResultItem(id=item_id, status="skipped", reason="too_large")
+    data = handle.read(ctx.max_bytes + 1)
+    if len(data) > ctx.max_bytes:
+        return ResultItem(id=item_id, status="skipped", reason="too_large")
+    if data.find(b"\x00", 0, BINARY_PREFIX_BYTES) != -1:
+        return ResultItem(id=item_id, status="skipped", reason="binary")
+    counts, digest = count_bytes(data, ctx)
+    return ok_result(item_id, counts, len(data), digest=digest)
 
 
-def main() -> int:
-    parser = build_parser()
-    args = parse_args(parser)
+def process_zip_member(
+    archive: zipfile.ZipFile, info: zipfile.ZipInfo, member_id: str, ctx: CountContext
+) -> ResultItem:
+    """Count one zip member, skipping it rather than the archive on failure.
 
-    if args.max_bytes < 0:
-        parser.error("--max-bytes must be >= 0")
+    zipfile raises RuntimeError for encrypted members, NotImplementedError
+    for unsupported methods and BadZipFile for a CRC mismatch at the end.
+    """
+    import zipfile
 
-    inputs = collect_inputs(args)
-    if not inputs:
-        parser.print_help()
-        return 2
+    if info.flag_bits & 0x1:
+        return ResultItem(id=member_id, status="skipped", reason="encrypted")
+    try:
+        with archive.open(info) as member:
+            return process_member(member_id, member, info.file_size, ctx)
+    except NotImplementedError:  # before RuntimeError, its base class
+        return ResultItem(
+            id=member_id, status="skipped", reason="unsupported_compression"
+        )
+    except RuntimeError:
+        return ResultItem(id=member_id, status="skipped", reason="encrypted")
+    except (OSError, EOFError, ValueError, zipfile.BadZipFile):
+        return ResultItem(id=member_id, status="skipped", reason="bad_archive")
+
+
+def process_archive(path: str, ctx: CountContext) -> List[ResultItem]:
+    """Count archive members as ``path!member`` without extracting to disk.
+
+    Zip members are read through the central directory; tar streams are read
+    sequentially (``r|``) after decompression, so nothing is buffered beyond
+    the member being counted. A bare compressed file is one result under
+    ``path``. ``--max-bytes`` applies to each decompressed member.
+    """
+    import lzma
+    import tarfile
+    import zipfile
 
+    errors: tuple[type[Exception], ...] = (
+        OSError,
+        EOFError,
+        ValueError,
+        lzma.LZMAError,
+        zipfile.BadZipFile,
+        tarfile.TarError,
+    )
     try:
-        encoder = tiktoken.get_encoding(args.encoding)
-    except Exception:
-        sys.stderr.write(f"Unknown encoding: {args.encoding}\n")
-        return 2
+        from compression import zstd
 
+        errors += (zstd.ZstdError,)
+    except ImportError:
+        pass
+    container, compression = archive_format(path) or (None, None)
     results: List[ResultItem] = []
-    for item in inputs:
-        if item.kind == "text":
-            results.append(process_text(item, encoder))
-        else:
-            results.append(process_path(item.path or "", args.max_bytes, encoder))
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_NONBLOCK", 0))
+    except OSError:
+        return [ResultItem(id=path, status="skipped", reason="not_a_file")]
+    try:
+        with os.fdopen(fd, "rb") as handle:
+            if not stat.S_ISREG(os.fstat(handle.fileno()).st_mode):
+                return [ResultItem(id=path, status="skipped", reason="not_a_file")]
+            if container == "zip":
+                with zipfile.ZipFile(handle) as archive:
+                    for info in archive.infolist():
+                        if info.is_dir():
+                            continue
+                        member_id = f"{path}{ARCHIVE_SEPARATOR}{info.filename}"
+                        results.append(
+                            process_zip_member(archive, info, member_id, ctx)
+                        )
+                return results
+            stream = open_decompressed(handle, compression) if compression else handle
+            if container != "tar":
+                return [process_member(path, stream, None, ctx)]
+            with tarfile.open(fileobj=stream, mode="r|") as archive:
+                for info in archive:
+                    member = archive.extractfile(info) if info.isfile() else None
+                    if member is None:
+                        continue
+                    member_id = f"{path}{ARCHIVE_SEPARATOR}{info.name}"
+                    results.append(process_member(member_id, member, info.size, ctx))
+            return results
+    except LookupError:
+        results.append(
+            ResultItem(id=path, status="skipped", reason="unsupported_compression")
+        )
+    except errors:
+        results.append(ResultItem(id=path, status="skipped", reason="bad_archive"))
+    return results
 
-    totals = summarize(results)
 
-    if args.json:
-        emit_json(results, totals, args.encoding, args.max_bytes)
-    else:
-        out_console = Console(file=sys.stdout)
-        err_console = Console(file=sys.stderr, stderr=True)
-        emit_human(results, totals, out_console, err_console)
+def process_text(item: InputItem, ctx: CountContext) -> ResultItem:
+    text = item.text or ""
+    return ok_result(
+        item.id,
+        count_text(text, ctx.encoders),
+        item.bytes_len if item.bytes_len is not None else len(text.encode("utf-8")),
+    )
+
+
+def process_stream(item_id: str, handle: BinaryIO, ctx: CountContext) -> ResultItem:
+    counts, bytes_len, digest = count_stream(
+        handle, ctx.encoders, digest=ctx.dedup is not None
+    )
+    if counts is None:
+        return ResultItem(id=item_id, status="skipped", reason="binary")
+    return ok_result(item_id, counts, bytes_len, digest=digest)
+
+
+def process_change(change: BlobChange, ctx: CountContext) -> ResultItem:
+    if change.too_large:
+        return ResultItem(id=change.path, status="skipped", reason="too_large")
+    sides = [data for data in (change.old, change.new) if data is not None]
+    if any(
+        data.counts is None
+        if isinstance(data, StreamedBlob)
+        else data.find(b"\x00", 0, BINARY_PREFIX_BYTES) != -1
+        for data in sides
+    ):
+        return ResultItem(id=change.path, status="skipped", reason="binary")
+
+    def side_counts(data: bytes | StreamedBlob | None) -> List[int]:
+        if data is None:
+            return [0] * len(ctx.encoders)
+        if isinstance(data, StreamedBlob):
+            return data.counts or []
+        return count_bytes(data, ctx)[0]
+
+    before = side_counts(change.old)
+    after = side_counts(change.new)
+    new = change.new
+    return ResultItem(
+        id=change.path,
+        status="ok",
+        tokens=after[0],
+        bytes_len=new.bytes_len if isinstance(new, StreamedBlob) else len(new or b""),
+        extra_tokens=tuple(after[1:]),
+        change=change.status,
+        before=tuple(before),
+    )
+
+
+def process_batch(items: List[InputItem], ctx: CountContext) -> List[ResultItem]:
+    """Read and encode a batch of inputs, preserving input order.
+
+    tiktoken's ``encode_batch`` is a thread map over ``encode``, so batches
+    call ``encode`` directly rather than nesting a pool inside each worker.
+    """
+    results: List[ResultItem] = []
+    for item in items:
+        if item.kind == "path" and ctx.archives and archive_format(item.path or ""):
+            results.extend(process_archive(item.path or "", ctx))
+            continue
+        if item.kind == "path":
+            result = process_path(item.path or "", ctx)
+        elif item.kind == "stream":
+            result = process_stream(item.id, item.handle or sys.stdin.buffer, ctx)
+        else:
+            result = process_text(item, ctx)
+        results.append(result)
+    return results
+
+
+class TopResults(NamedTuple):
+    items: List[ResultItem]  # the heaviest ok results, heaviest first
+    skipped: List[ResultItem]  # the first TOP_MAX_SKIPS skipped results
+    skipped_reasons: dict[str, int]  # every skipped result, by reason
+
+
+class Failure(NamedTuple):
+    """An exception raised on a helper thread, re-raised by its consumer."""
+
+    exc: BaseException
+
+
+class Intake:
+    """Drain an input iterator on a daemon thread into a bounded buffer.
+
+    Lets consumers see whether more input is ready without blocking, so a
+    stalled source (a pipe between writes) flushes partial batches instead
+    of holding them until the next line arrives. ``SimpleQueue`` keeps the
+    per-item cost low; the bound is enforced coarsely with an Event.
+    ``close()`` stops the thread at its next item when the consumer quits
+    early, so a server does not leak one per request.
+    """
+
+    _DONE = object()
+
+    def __init__(self, items: Iterable[InputItem]) -> None:
+        import queue
+
+        self._queue: queue.SimpleQueue[object] = queue.SimpleQueue()
+        self._room = threading.Event()
+        self._room.set()
+        self._closed = threading.Event()
+        thread = threading.Thread(target=self._run, args=(items,), daemon=True)
+        thread.start()
+
+    def _run(self, items: Iterable[InputItem]) -> None:
+        source = iter(items)
+        try:
+            for item in source:
+                if self._closed.is_set():
+                    break
+                self._queue.put(item)
+                if self._queue.qsize() >= INTAKE_MAX_ITEMS:
+                    self._room.clear()
+                    if self._queue.qsize() >= INTAKE_MAX_ITEMS:
+                        self._room.wait()
+        except BaseException as exc:
+            self._queue.put(Failure(exc))
+            return
+        finally:
+            close_iterator(source)
+        self._queue.put(self._DONE)
+
+    def close(self) -> None:
+        self._closed.set()
+        self._room.set()
+
+    def ready(self) -> bool:
+        return not self._queue.empty()
+
+    def get(self) -> InputItem | None:
+        """Next item, blocking until one arrives; None at the end."""
+        item = self._queue.get()
+        if not self._room.is_set() and self._queue.qsize() < INTAKE_MAX_ITEMS // 2:
+            self._room.set()
+        if item is self._DONE:
+            return None
+        if isinstance(item, Failure):
+            raise item.exc
+        return item  # type: ignore[return-value]
+
+
+def iter_batches(items: Iterable[InputItem]) -> Iterator[List[InputItem]]:
+    """Group inputs into batches bounded by item count and known text size.
+
+    A partial batch is yielded as soon as no further input is ready, so
+    paths trickling in on stdin are counted as they arrive.
+    """
+    intake = Intake(items)
+    batch: List[InputItem] = []
+    batch_bytes = 0
+    try:
+        while True:
+            if batch and not intake.ready():
+                yield batch
+                batch = []
+                batch_bytes = 0
+            item = intake.get()
+            if item is None:
+                break
+            batch.append(item)
+            batch_bytes += item.bytes_len or 0
+            if len(batch) >= BATCH_MAX_ITEMS or batch_bytes >= BATCH_MAX_BYTES:
+                yield batch
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield batch
+    finally:
+        intake.close()
+
+
+def close_iterator(items: Iterator[object]) -> None:
+    close = getattr(items, "close", None)
+    if close is not None:
+        close()
+
+
+def ordered_map(fn: Callable[[T], R], items: Iterable[T], jobs: int) -> Iterator[R]:
+    """Map ``fn`` over ``items`` on a thread pool, yielding results in order.
+
+    At most ``jobs * WINDOW_PER_JOB`` tasks are in flight, so results stream
+    out as the head of the queue completes instead of after the whole input.
+    Tasks are submitted from a feeder thread, so a slow ``items`` iterator
+    never holds back results that are already done. ``items`` is closed
+    (if it is a generator) when the consumer stops early.
+    """
+    source = iter(items)
+    if jobs <= 1:
+        try:
+            for item in source:
+                yield fn(item)
+        finally:
+            close_iterator(source)
+        return
+
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    window: queue.Queue[Future[R] | Failure | None] = queue.Queue(jobs * WINDOW_PER_JOB)
+    stop = threading.Event()
+
+    def feed() -> None:
+        try:
+            for item in source:
+                future = executor.submit(fn, item)
+                while not stop.is_set():
+                    try:
+                        window.put(future, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    future.cancel()
+                    return
+        except BaseException as exc:
+            # After a stop, submit() fails because the executor shut down.
+            if not stop.is_set():
+                window.put(Failure(exc))
+            return
+        finally:
+            # The feeder owns iteration, so it closes the source as well.
+            close_iterator(source)
+        window.put(None)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                future = window.get()
+                if future is None:
+                    break
+                if isinstance(future, Failure):
+                    raise future.exc
+                yield future.result()
+        finally:
+            # Reached when the consumer stops early (e.g. --budget).
+            stop.set()
+            while True:
+                try:
+                    pending = window.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is not None and not isinstance(pending, Failure):
+                    pending.cancel()
+
+
+def iter_results(
+    inputs: Iterable[InputItem], ctx: CountContext, jobs: int
+) -> Iterator[ResultItem]:
+    """Yield one result per input, in input order, using ``jobs`` workers."""
+
+    def run(batch: List[InputItem]) -> List[ResultItem]:
+        return process_batch(batch, ctx)
+
+    for batch_results in ordered_map(run, iter_batches(inputs), jobs):
+        yield from batch_results
+
+
+def gitignore_regex(pattern: str) -> str:
+    """Translate one gitignore glob into a regex over ``/``-separated paths."""
+    out: List[str] = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i):
+                if pattern.startswith("**/", i):
+                    out.append("(?:.*/)?")
+                    i += 3
+                else:
+                    out.append(".*")
+                    i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1 : end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class GitIgnore:
+    """Rules from one ``.gitignore``, matched against paths below ``base``."""
+
+    def __init__(self, base: str, lines: Iterable[str]) -> None:
+        self.base = base
+        self.rules: List[tuple[re.Pattern[str], bool, bool, bool]] = []
+        for raw in lines:
+            line = raw.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if not line:
+                continue
+            regex = re.compile(gitignore_regex(line) + r"\Z", re.DOTALL)
+            self.rules.append((regex, negate, dir_only, anchored))
+
+    def match(self, rel: str, name: str, is_dir: bool) -> bool | None:
+        """Return True if ignored, False if re-included, None if no rule applies."""
+        for regex, negate, dir_only, anchored in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel if anchored else name):
+                return not negate
+        return None
+
+
+def load_gitignore(directory: str, base: str) -> GitIgnore | None:
+    try:
+        with open(os.path.join(directory, ".gitignore"), encoding="utf-8") as handle:
+            return GitIgnore(base, handle.readlines())
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def parent_gitignores(root: str) -> List[GitIgnore]:
+    """Collect ``.gitignore`` rules from ``root``'s ancestors up to the repo top."""
+    matchers: List[GitIgnore] = []
+    current = os.path.abspath(root)
+    while True:
+        parent = os.path.dirname(current)
+        if os.path.exists(os.path.join(current, ".git")) or parent == current:
+            break
+        current = parent
+        matcher = load_gitignore(current, current)
+        if matcher is not None:
+            matchers.insert(0, matcher)
+    return matchers
+
+
+def is_ignored(
+    matchers: List[GitIgnore], abs_path: str, name: str, is_dir: bool
+) -> bool:
+    # Deeper .gitignore files take precedence over their parents.
+    for matcher in reversed(matchers):
+        verdict = matcher.match(abs_path[len(matcher.base) + 1 :], name, is_dir)
+        if verdict is not None:
+            return verdict
+    return False
+
+
+def glob_match(globs: List[str], rel: str, name: str) -> bool:
+    return any(
+        fnmatch.fnmatchcase(name, glob) or fnmatch.fnmatchcase(rel, glob)
+        for glob in globs
+    )
+
+
+def walk_files(
+    root: str,
+    args: argparse.Namespace,
+    on_dir: Callable[[str], None] | None = None,
+    subpath: str | None = None,
+) -> Iterator[str]:
+    """Yield files under ``root`` in sorted depth-first order.
+
+    Hidden, ignored and excluded directories are pruned before descending,
+    so ignored trees such as ``node_modules`` cost one name check. Symlinks
+    to directories are skipped silently. ``on_dir`` is called with every
+    directory that is entered. With ``subpath`` (a file or directory below
+    ``root``), only that entry is walked, filtered as a full walk would.
+    """
+    use_ignore = not args.no_ignore
+    abs_root = os.path.abspath(root)
+    initial = parent_gitignores(abs_root) if use_ignore else []
+
+    def pruned(
+        name: str,
+        entry_abs: str,
+        entry_rel: str,
+        is_dir: bool,
+        matchers: List[GitIgnore],
+    ) -> bool:
+        if name == ".git" or (name.startswith(".") and not args.hidden):
+            return True
+        if use_ignore and is_ignored(matchers, entry_abs, name, is_dir):
+            return True
+        return bool(args.exclude) and glob_match(args.exclude, entry_rel, name)
+
+    def walk(
+        path: str, abs_path: str, rel: str, matchers: List[GitIgnore]
+    ) -> Iterator[str]:
+        if on_dir is not None:
+            on_dir(path)
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        if use_ignore and any(entry.name == ".gitignore" for entry in entries):
+            matcher = load_gitignore(path, abs_path)
+            if matcher is not None:
+                matchers = [*matchers, matcher]
+        for entry in entries:
+            name = entry.name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                # Like fd and rglob, neither descend into nor report
+                # symlinked directories (stow trees are full of them).
+                if not is_dir and entry.is_symlink() and entry.is_dir():
+                    continue
+            except OSError:
+                continue
+            entry_abs = f"{abs_path}/{name}"
+            entry_rel = f"{rel}{name}"
+            if pruned(name, entry_abs, entry_rel, is_dir, matchers):
+                continue
+            if is_dir:
+                yield from walk(entry.path, entry_abs, f"{entry_rel}/", matchers)
+            elif not args.include or glob_match(args.include, entry_rel, name):
+                yield entry.path
+
+    def walk_subpath(target: str) -> Iterator[str]:
+        # Descend from root one component at a time, collecting the same
+        # .gitignore rules and prunes a full walk would apply on the way.
+        names = os.path.relpath(target, root).split(os.sep)
+        path, abs_path, rel, matchers = root, abs_root, "", initial
+        for depth, name in enumerate(names):
+            if use_ignore:
+                matcher = load_gitignore(path, abs_path)
+                if matcher is not None:
+                    matchers = [*matchers, matcher]
+            entry_path = os.path.join(path, name)
+            try:
+                mode = os.lstat(entry_path).st_mode
+                if stat.S_ISLNK(mode) and os.path.isdir(entry_path):
+                    return
+            except OSError:
+                return
+            is_dir = stat.S_ISDIR(mode)
+            last = depth == len(names) - 1
+            entry_abs = f"{abs_path}/{name}"
+            entry_rel = f"{rel}{name}"
+            if (not last and not is_dir) or pruned(
+                name, entry_abs, entry_rel, is_dir, matchers
+            ):
+                return
+            if not last:
+                path, abs_path, rel = entry_path, entry_abs, f"{entry_rel}/"
+            elif is_dir:
+                yield from walk(entry_path, entry_abs, f"{entry_rel}/", matchers)
+            elif not args.include or glob_match(args.include, entry_rel, name):
+                yield entry_path
+
+    if subpath is None:
+        return walk(root, abs_root, "", initial)
+    return walk_subpath(subpath)
+
+
+class LimitedReader(io.RawIOBase):
+    """The next ``size`` bytes of ``handle``, then EOF."""
+
+    def __init__(self, handle: BinaryIO, size: int) -> None:
+        self._handle = handle
+        self.remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:
+        if self.remaining <= 0:
+            return 0
+        data = self._handle.read(min(len(buffer), self.remaining))
+        if not data:
+            raise EOFError("git cat-file: blob ended early")
+        buffer[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+class BlobReader:
+    """Blob contents from one long-lived ``git cat-file --batch`` process."""
+
+    def __init__(self) -> None:
+        import subprocess
+
+        self._proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def read(
+        self,
+        sha: str,
+        limit: int,
+        encoders: List[tiktoken.Encoding] | None = None,
+    ) -> bytes | StreamedBlob | None:
+        """Return a blob of at most ``limit`` bytes.
+
+        A larger blob is counted in chunks straight off the pipe when
+        ``encoders`` is given (``--stream``), otherwise drained and None.
+        """
+        assert self._proc.stdin is not None and self._proc.stdout is not None
+        self._proc.stdin.write(f"{sha}\n".encode())
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().split()
+        if len(header) != 3:
+            raise ValueError(f"git cat-file: cannot read object {sha}")
+        size = int(header[2])
+        data: bytes | StreamedBlob | None = None
+        if size <= limit:
+            data = self._proc.stdout.read(size)
+            size = 0
+        elif encoders is not None:
+            blob = LimitedReader(self._proc.stdout, size)
+            counts, bytes_len, _ = count_stream(io.BufferedReader(blob), encoders)
+            data = StreamedBlob(counts, bytes_len)
+            size = blob.remaining  # left over when a binary blob stops early
+        while size > 0:
+            size -= len(self._proc.stdout.read(min(size, STREAM_CHUNK_BYTES)))
+        self._proc.stdout.read(1)  # trailing newline
+        return data
+
+    def close(self) -> None:
+        if self._proc.stdin is not None:
+            self._proc.stdin.close()
+        self._proc.wait()
+
+
+def git_diff_entries(spec: str, paths: List[str]) -> List[tuple[str, str, str, str]]:
+    """Return ``(status, path, old_sha, new_sha)`` for blobs changed in ``spec``.
+
+    A sha is empty when that side has no regular-file blob (added, deleted,
+    symlink or submodule).
+    """
+    import subprocess
+
+    result = subprocess.run(
+        ["git", "diff", "--raw", "-z", "--no-renames", "--no-abbrev", spec, "--"]
+        + paths,
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        message = result.stderr.decode("utf-8", "replace").strip()
+        raise ValueError(message or f"git diff {spec} failed")
+    fields = result.stdout.split(b"\0")
+    entries = []
+    for meta, raw_path in zip(fields[0::2], fields[1::2]):
+        old_mode, new_mode, old_sha, new_sha, status = meta[1:].decode().split()
+        entries.append(
+            (
+                status[0],
+                os.fsdecode(raw_path),
+                old_sha if old_mode.startswith("100") else "",
+                new_sha if new_mode.startswith("100") else "",
+            )
+        )
+    return entries
+
+
+def iter_changes(
+    entries: List[tuple[str, str, str, str]],
+    args: argparse.Namespace,
+    encoders: List[tiktoken.Encoding],
+) -> Iterator[BlobChange]:
+    """Read both sides of each changed file, in diff order, from git objects.
+
+    With ``--stream``, blobs over ``--max-bytes`` are counted here as they
+    leave the pipe, so memory stays bounded by the chunk size.
+    """
+    streaming = encoders if args.stream else None
+    reader = BlobReader()
+    try:
+        for status, path, old_sha, new_sha in entries:
+            name = os.path.basename(path)
+            hidden = any(part.startswith(".") for part in path.split("/"))
+            if (hidden and not args.hidden) or (not old_sha and not new_sha):
+                continue
+            if args.exclude and glob_match(args.exclude, path, name):
+                continue
+            if args.include and not glob_match(args.include, path, name):
+                continue
+            old = reader.read(old_sha, args.max_bytes, streaming) if old_sha else None
+            new = reader.read(new_sha, args.max_bytes, streaming) if new_sha else None
+            too_large = (old_sha and old is None) or (new_sha and new is None)
+            yield BlobChange(path, status, old, new, too_large=bool(too_large))
+    finally:
+        reader.close()
+
+
+def collect_inputs(
+    args: argparse.Namespace, on_dir: Callable[[str], None] | None = None
+) -> Iterator[InputItem]:
+    """Yield inputs lazily so counting starts while stdin is still arriving."""
+    stdin_bytes: bytes | None = None
+    for path in args.paths:
+        if path == "-" and args.stream:
+            yield InputItem(id="<stdin>", kind="stream")
+        elif path == "-":
+            if stdin_bytes is None:
+                stdin_bytes = read_stdin_bytes()
+            yield InputItem(
+                id="<stdin>",
+                kind="text",
+                text=stdin_bytes.decode("utf-8", errors="replace"),
+                bytes_len=len(stdin_bytes),
+            )
+        elif os.path.isdir(path):
+            for file_path in walk_files(path, args, on_dir):
+                yield InputItem(id=file_path, kind="path", path=file_path)
+        else:
+            yield InputItem(id=path, kind="path", path=path)
+
+    if "-" in args.paths or sys.stdin.isatty():
+        return
+    yield from stdin_inputs(choose_stdin_mode(args), sys.stdin.buffer, args.stream)
+
+
+class Totals:
+    """Running totals, updated one result at a time."""
+
+    def __init__(
+        self, encodings: List[str], budget: int | None = None, delta: bool = False
+    ) -> None:
+        self.encodings = encodings
+        self.counts = [0] * len(encodings)
+        # With delta, counts are at the new revision and budget caps the delta.
+        self.delta = delta
+        self.before_counts = [0] * len(encodings)
+        # Counts with duplicate content included once; what packing costs.
+        self.unique_counts = [0] * len(encodings)
+        self.ok = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.budget = budget
+        self.over_budget = False
+
+    def add(self, item: ResultItem) -> None:
+        if item.status != "ok":
+            self.skipped += 1
+            return
+        self.ok += 1
+        counts = (item.tokens or 0, *item.extra_tokens)
+        for index, tokens in enumerate(counts):
+            self.counts[index] += tokens
+        for index, tokens in enumerate(item.before or ()):
+            self.before_counts[index] += tokens
+        if item.duplicate_of is not None:
+            self.duplicates += 1
+        else:
+            for index, tokens in enumerate(counts):
+                self.unique_counts[index] += tokens
+        if self.delta:
+            capped = self.counts[0] - self.before_counts[0]
+        else:
+            capped = self.unique_counts[0]
+        if self.budget is not None and capped > self.budget:
+            self.over_budget = True
+
+    def as_dict(self, cache: TokenCache | None = None) -> dict:
+        totals = {
+            "tokens": self.counts[0],
+            "tokens_unique": self.unique_counts[0],
+            "ok": self.ok,
+            "skipped": self.skipped,
+            "duplicates": self.duplicates,
+            "inputs": self.ok + self.skipped,
+        }
+        if len(self.encodings) > 1:
+            totals["tokens_by_encoding"] = dict(zip(self.encodings, self.counts))
+            totals["tokens_unique_by_encoding"] = dict(
+                zip(self.encodings, self.unique_counts)
+            )
+        if self.delta:
+            deltas = [a - b for a, b in zip(self.counts, self.before_counts)]
+            totals["tokens_before"] = self.before_counts[0]
+            totals["tokens_delta"] = deltas[0]
+            if len(self.encodings) > 1:
+                totals["tokens_delta_by_encoding"] = dict(zip(self.encodings, deltas))
+        if self.budget is not None:
+            totals["budget"] = self.budget
+            totals["over_budget"] = self.over_budget
+        if cache is not None:
+            totals["cache_hits"] = cache.hits
+            totals["cache_misses"] = cache.misses
+        return totals
+
+
+class ResultStore:
+    """Results kept column-wise for output after counting finishes.
+
+    A ResultItem costs a tuple, two int objects and a digest, which dominates
+    RSS at millions of paths. Here an item is its id string plus one array
+    slot per column: tokens per encoding and bytes (-1 for None), and a byte
+    indexing an interned ``(status, reason)`` table. Rare fields (duplicate
+    ids, sections, git deltas) are kept in sparse dicts. Digests are dropped;
+    duplicates are already marked.
+    """
+
+    def __init__(self, n_encodings: int) -> None:
+        from array import array
+
+        self._ids: List[str] = []
+        self._tokens = [array("q") for _ in range(n_encodings)]
+        self._bytes = array("q")
+        self._codes = array("B")
+        self._labels: List[tuple[str, str | None]] = []
+        self._label_codes: dict[tuple[str, str | None], int] = {}
+        self._sparse: dict[int, tuple] = {}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def append(self, item: ResultItem) -> None:
+        label = (item.status, item.reason)
+        code = self._label_codes.get(label)
+        if code is None:
+            code = self._label_codes[label] = len(self._labels)
+            self._labels.append(label)
+        index = len(self._ids)
+        self._ids.append(item.id)
+        self._codes.append(code)
+        self._bytes.append(-1 if item.bytes_len is None else item.bytes_len)
+        counts = () if item.tokens is None else (item.tokens, *item.extra_tokens)
+        for column_index, column in enumerate(self._tokens):
+            column.append(counts[column_index] if counts else -1)
+        if item.duplicate_of or item.sections or item.change:
+            self._sparse[index] = (
+                item.duplicate_of,
+                item.sections,
+                item.change,
+                item.before,
+            )
+
+    def extend(self, items: Iterable[ResultItem]) -> None:
+        for item in items:
+            self.append(item)
+
+    def __iter__(self) -> Iterator[ResultItem]:
+        labels = self._labels
+        for index, item_id in enumerate(self._ids):
+            status, reason = labels[self._codes[index]]
+            tokens = self._tokens[0][index]
+            bytes_len = self._bytes[index]
+            duplicate_of, sections, change, before = self._sparse.get(
+                index, (None, (), None, None)
+            )
+            yield ResultItem(
+                id=item_id,
+                status=status,
+                tokens=None if tokens < 0 else tokens,
+                bytes_len=None if bytes_len < 0 else bytes_len,
+                reason=reason,
+                extra_tokens=tuple(column[index] for column in self._tokens[1:])
+                if tokens >= 0
+                else (),
+                sections=sections,
+                duplicate_of=duplicate_of,
+                change=change,
+                before=before,
+            )
+
+
+class QuantileSketch:
+    """Relative-error quantiles in bounded memory (a DDSketch-style histogram).
+
+    Values fall into logarithmic buckets ``SKETCH_ACCURACY`` wide, so a
+    reported quantile is within 1% of a value at that rank, and token counts
+    up to billions need at most about a thousand buckets per sketch.
+    """
+
+    def __init__(self) -> None:
+        self._gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets: dict[int, int] = {}
+        self._zeros = 0
+        self.count = 0
+
+    def add(self, value: int) -> None:
+        self.count += 1
+        if value <= 0:
+            self._zeros += 1
+            return
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self._buckets[key] = self._buckets.get(key, 0) + 1
+
+    def quantile(self, q: float) -> int:
+        rank = q * (self.count - 1)
+        seen = self._zeros
+        if self.count == 0 or rank < seen:
+            return 0
+        for key in sorted(self._buckets):
+            seen += self._buckets[key]
+            if seen > rank:
+                return round(2 * self._gamma**key / (self._gamma + 1))
+        return 0
+
+
+class GroupStats:
+    """Per-group sums, exact max and p50/p95 sketches, fed one result at a time.
+
+    Nothing per item is kept, so memory grows with the number of groups only.
+    """
+
+    def __init__(self, key: Callable[[str], str], encodings: List[str]) -> None:
+        self.key = key
+        self.encodings = encodings
+        self.groups: dict[str, dict] = {}
+        self.skipped_reasons: dict[str, int] = {}
+
+    def add(self, item: ResultItem) -> None:
+        name = self.key(item.id)
+        group = self.groups.get(name)
+        if group is None:
+            group = self.groups[name] = {
+                "files": 0,
+                "skipped": 0,
+                "counts": [0] * len(self.encodings),
+                "bytes": 0,
+                "max": 0,
+                "sketch": QuantileSketch(),
+            }
+        if item.status != "ok":
+            group["skipped"] += 1
+            reason = item.reason or item.status
+            self.skipped_reasons[reason] = self.skipped_reasons.get(reason, 0) + 1
+            return
+        tokens = item.tokens or 0
+        group["files"] += 1
+        for index, count in enumerate((tokens, *item.extra_tokens)):
+            group["counts"][index] += count
+        group["bytes"] += item.bytes_len or 0
+        group["max"] = max(group["max"], tokens)
+        group["sketch"].add(tokens)
+
+    def rows(self) -> List[dict]:
+        """Groups heaviest first, as JSON-ready dicts."""
+        rows = []
+        for name, group in self.groups.items():
+            counts = group["counts"]
+            row = {
+                "group": name,
+                "files": group["files"],
+                "skipped": group["skipped"],
+                "tokens": counts[0],
+                "bytes": group["bytes"],
+                # Bucket midpoints can overshoot the largest value by <1%.
+                "p50": min(group["sketch"].quantile(0.5), group["max"]),
+                "p95": min(group["sketch"].quantile(0.95), group["max"]),
+                "max": group["max"],
+            }
+            if len(self.encodings) > 1:
+                row["tokens_by_encoding"] = dict(zip(self.encodings, counts))
+            rows.append(row)
+        rows.sort(key=lambda row: (-row["tokens"], row["group"]))
+        return rows
+
+
+def group_key(spec: str) -> Callable[[str], str] | None:
+    """Key function for ``--group-by``; None if ``spec`` is not valid."""
+    if spec == "ext":
+
+        def by_ext(item_id: str) -> str:
+            name = item_id.rpartition(ARCHIVE_SEPARATOR)[2]
+            if archive_source(item_id) == item_id:
+                name = item_id
+            return os.path.splitext(os.path.basename(name))[1].lower() or "(none)"
+
+        return by_ext
+    if spec == "dir":
+        depth = 1
+    elif spec.startswith("depth=") and spec[len("depth=") :].isdigit():
+        depth = int(spec[len("depth=") :])
+    else:
+        return None
+
+    def by_dir(item_id: str) -> str:
+        if item_id.startswith("<"):
+            return item_id  # <stdin>
+        path = os.path.normpath(archive_source(item_id))
+        if os.path.isabs(path):
+            # Relative to the cwd when inside it; otherwise keep it absolute.
+            relative = os.path.relpath(path)
+            if not relative.startswith(".."):
+                path = relative
+        parts = path.split(os.sep)[:-1]
+        if parts and parts[0] == "":
+            return "/" + "/".join(parts[1 : depth + 1])
+        return "/".join(parts[:depth]) or "."
+
+    return by_dir
+
+
+def mark_duplicates(results: Iterable[ResultItem]) -> Iterator[ResultItem]:
+    """Point results at the first earlier input with the same content digest."""
+    first_ids: dict[bytes, str] = {}
+    for item in results:
+        if item.digest is not None:
+            first_id = first_ids.setdefault(item.digest, item.id)
+            if first_id != item.id:
+                item = item._replace(duplicate_of=first_id)
+        yield item
+
+
+def tally(results: Iterable[ResultItem], totals: Totals) -> Iterator[ResultItem]:
+    """Add each result to ``totals`` as it passes; stop once over budget."""
+    for item in results:
+        totals.add(item)
+        yield item
+        if totals.over_budget:
+            return
+
+
+def item_deltas(item: ResultItem) -> List[int]:
+    after = (item.tokens or 0, *item.extra_tokens)
+    return [a - b for a, b in zip(after, item.before or [0] * len(after))]
+
+
+def top_results(
+    results: Iterable[ResultItem], k: int, by_delta: bool = False
+) -> TopResults:
+    """Return the ``k`` heaviest ok results, keeping only ``k`` in memory.
+
+    With ``by_delta``, weight is the absolute token change instead. Skipped
+    results are kept up to ``TOP_MAX_SKIPS`` and otherwise counted by reason.
+    """
+    heap: List[tuple[int, int, ResultItem]] = []
+    skipped: List[ResultItem] = []
+    reasons: dict[str, int] = {}
+    for index, item in enumerate(results):
+        if item.status == "skipped":
+            reason = item.reason or "unknown"
+            reasons[reason] = reasons.get(reason, 0) + 1
+            if len(skipped) < TOP_MAX_SKIPS:
+                skipped.append(item)
+            continue
+        if item.status != "ok" or k == 0:
+            continue
+        weight = abs(item_deltas(item)[0]) if by_delta else item.tokens or 0
+        # Ties keep the earlier input: later indexes compare smaller.
+        entry = (weight, -index, item)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        else:
+            heapq.heappushpop(heap, entry)
+    items = [item for _, _, item in sorted(heap, reverse=True)]
+    return TopResults(items, skipped, reasons)
+
+
+def format_tokens(encodings: List[str], tokens: int, extra: Iterable[int]) -> str:
+    if len(encodings) == 1:
+        return f"tokens={tokens}"
+    return " ".join(
+        f"{name}={count}" for name, count in zip(encodings, (tokens, *extra))
+    )
+
+
+def format_deltas(encodings: List[str], deltas: List[int]) -> str:
+    if len(encodings) == 1:
+        return f"delta={deltas[0]:+d}"
+    return " ".join(f"{name}={delta:+d}" for name, delta in zip(encodings, deltas))
+
+
+def print_item(console: Console, item: ResultItem, encodings: List[str]) -> None:
+    counts = format_tokens(encodings, item.tokens or 0, item.extra_tokens)
+    if item.change is not None:
+        deltas = format_deltas(encodings, item_deltas(item))
+        console.print(
+            f"{item.change} {item.id} {deltas} ({counts})",
+            highlight=False,
+            markup=False,
+        )
+        return
+    console.print(
+        f"{item.id} {counts} bytes={item.bytes_len}", highlight=False, markup=False
+    )
+    if item.duplicate_of is not None:
+        console.print(
+            f"  duplicate of {item.duplicate_of}",
+            highlight=False,
+            markup=False,
+            soft_wrap=True,
+        )
+    for section in item.sections:
+        console.print(
+            f"  {section.heading} tokens={section.tokens} "
+            f"bytes={section.end - section.start}",
+            highlight=False,
+            markup=False,
+            soft_wrap=True,
+        )
+
+
+def print_total(console: Console, totals: dict, encodings: List[str]) -> None:
+    by_encoding = totals.get("tokens_by_encoding", {})
+    counts = format_tokens(
+        encodings, totals["tokens"], [by_encoding[name] for name in encodings[1:]]
+    )
+    if "tokens_delta" in totals:
+        by_encoding = totals.get("tokens_delta_by_encoding", {})
+        deltas = [by_encoding.get(name, totals["tokens_delta"]) for name in encodings]
+        counts = f"{format_deltas(encodings, deltas)} ({counts})"
+    unique = ""
+    if totals["duplicates"]:
+        unique = f" unique={totals['tokens_unique']} duplicates={totals['duplicates']}"
+    console.print(
+        f"total {counts}{unique} ok={totals['ok']} skipped={totals['skipped']}",
+        highlight=False,
+        markup=False,
+    )
+
+
+def print_skip(console: Console, item: ResultItem) -> None:
+    console.print(f"SKIP {item.id} reason={item.reason}", highlight=False, markup=False)
+
+
+def print_skip_reasons(
+    console: Console, reasons: dict[str, int], unlisted: int | None = None
+) -> None:
+    counts = " ".join(f"{reason}={count}" for reason, count in sorted(reasons.items()))
+    more = f" ({unlisted} not listed)" if unlisted else ""
+    console.print(f"skipped {counts}{more}", highlight=False, markup=False)
+
+
+def emit_human(
+    results: Iterable[ResultItem],
+    totals: dict,
+    encodings: List[str],
+    out_console: Console,
+    err_console: Console,
+) -> None:
+    for item in results:
+        if item.status == "ok":
+            print_item(out_console, item, encodings)
+    print_total(out_console, totals, encodings)
+
+    for item in results:
+        if item.status == "skipped":
+            print_skip(err_console, item)
+
+    if totals.get("over_budget"):
+        measure = "delta" if "tokens_delta" in totals else "tokens"
+        err_console.print(
+            f"OVER BUDGET {measure}>{totals['budget']} (stopped early)",
+            highlight=False,
+        )
+
+
+def item_record(item: ResultItem, encodings: List[str]) -> dict:
+    record = {
+        "id": item.id,
+        "status": item.status,
+        **({"tokens": item.tokens} if item.tokens is not None else {}),
+        **({"bytes": item.bytes_len} if item.bytes_len is not None else {}),
+        **({"reason": item.reason} if item.reason else {}),
+        **({"duplicate_of": item.duplicate_of} if item.duplicate_of else {}),
+    }
+    if len(encodings) > 1 and item.tokens is not None:
+        record["tokens_by_encoding"] = dict(
+            zip(encodings, (item.tokens, *item.extra_tokens))
+        )
+    if item.change is not None:
+        deltas = item_deltas(item)
+        record["change"] = item.change
+        record["tokens_before"] = item.before[0] if item.before else 0
+        record["tokens_delta"] = deltas[0]
+        if len(encodings) > 1:
+            record["tokens_delta_by_encoding"] = dict(zip(encodings, deltas))
+    if item.sections:
+        record["sections"] = [section._asdict() for section in item.sections]
+    return record
+
+
+def encoding_field(encodings: List[str]) -> str | List[str]:
+    return encodings[0] if len(encodings) == 1 else encodings
+
+
+def emit_json(
+    results: Iterable[ResultItem],
+    totals: dict,
+    encodings: List[str],
+    max_bytes: int,
+) -> None:
+    """Write the same document as ``json.dumps(payload, indent=2)``.
+
+    Items are serialised one at a time so the output never holds a record
+    dict per file in memory.
+    """
+    out = sys.stdout
+
+    def field(key: str, value: object) -> str:
+        text = json.dumps(value, indent=2).replace("\n", "\n  ")
+        return f"  {json.dumps(key)}: {text}"
+
+    out.write("{\n")
+    out.write(field("encoding", encoding_field(encodings)) + ",\n")
+    out.write(field("max_bytes", max_bytes) + ",\n")
+    out.write('  "items": [')
+    separator = "\n    "
+    for item in results:
+        record = json.dumps(item_record(item, encodings), indent=2)
+        out.write(separator + record.replace("\n", "\n    "))
+        separator = ",\n    "
+    out.write("]" if separator == "\n    " else "\n  ]")
+    out.write(",\n" + field("total", totals) + "\n}\n")
+
+
+def emit_ndjson_items(results: Iterable[ResultItem], encodings: List[str]) -> None:
+    """Write each item as a JSON line as soon as it is ready."""
+    out = sys.stdout
+    for item in results:
+        out.write(json.dumps(item_record(item, encodings)) + "\n")
+        out.flush()
+
+
+def emit_ndjson_total(totals: dict, encodings: List[str], max_bytes: int) -> None:
+    record = {
+        "encoding": encoding_field(encodings),
+        "max_bytes": max_bytes,
+        "total": totals,
+    }
+    sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
+
+
+def approx_stratum(path: str) -> str:
+    archive = archive_format(path)
+    if archive is not None:
+        return next(suffix for suffix, fmt in ARCHIVE_SUFFIXES if fmt == archive)
+    return os.path.splitext(path)[1].lower() or "(none)"
+
+
+def sample_units(
+    inputs: Iterable[InputItem], ctx: CountContext
+) -> tuple[List[SampleUnit], List[InputItem], List[ResultItem]]:
+    """Split path inputs into sampling units using ``stat`` only.
+
+    Returns ``(units, exact, skipped)``: text and stream inputs are counted
+    exactly, and files the exact count would skip without reading them
+    (missing, not regular, over --max-bytes) are reported the same way.
+    """
+    units: List[SampleUnit] = []
+    exact: List[InputItem] = []
+    skipped: List[ResultItem] = []
+    for item in inputs:
+        if item.kind != "path":
+            exact.append(item)
+            continue
+        path = item.path or ""
+        try:
+            info = os.stat(path)
+        except OSError:
+            info = None
+        if info is None or not stat.S_ISREG(info.st_mode):
+            skipped.append(ResultItem(id=path, status="skipped", reason="not_a_file"))
+            continue
+        is_archive = ctx.archives and archive_format(path) is not None
+        if info.st_size > ctx.max_bytes and not ctx.stream and not is_archive:
+            skipped.append(ResultItem(id=path, status="skipped", reason="too_large"))
+            continue
+        stratum = approx_stratum(path)
+        if is_archive or info.st_size <= APPROX_CHUNK_BYTES:
+            units.append(SampleUnit(path, stratum, 0, info.st_size, True))
+            continue
+        for offset in range(0, info.st_size, APPROX_CHUNK_BYTES):
+            size = min(APPROX_CHUNK_BYTES, info.st_size - offset)
+            units.append(SampleUnit(path, stratum, offset, size, False))
+    return units, exact, skipped
+
+
+def count_unit(unit: SampleUnit, ctx: CountContext) -> List[int]:
+    """Tokens in one unit; binary and unreadable units count as zero tokens."""
+    zeros = [0] * len(ctx.encoders)
+    if unit.whole:
+        results = process_batch([InputItem(unit.path, "path", path=unit.path)], ctx)
+        counts = zeros
+        for item in results:
+            if item.status == "ok":
+                after = (item.tokens or 0, *item.extra_tokens)
+                counts = [a + b for a, b in zip(counts, after)]
+        return counts
+    try:
+        fd = os.open(unit.path, os.O_RDONLY)
+    except OSError:
+        return zeros
+    try:
+        if os.pread(fd, BINARY_PREFIX_BYTES, 0).find(b"\x00") != -1:
+            return zeros
+        data = os.pread(fd, unit.size, unit.offset)
+    except OSError:
+        return zeros
+    finally:
+        os.close(fd)
+    return count_bytes(data, ctx)[0]
+
+
+def estimate_stratum(
+    sizes: List[int], tokens: List[int], total_units: int, total_bytes: int
+) -> tuple[float, float]:
+    """Ratio estimate of a stratum's tokens and its variance.
+
+    Tokens per byte measured on the sample scale to the stratum's known byte
+    total; the variance is the usual ratio-estimator approximation with a
+    finite population correction, and zero when every unit was counted.
+    """
+    sampled_bytes = sum(sizes)
+    ratio = sum(tokens) / sampled_bytes if sampled_bytes else 0.0
+    estimate = ratio * total_bytes
+    n = len(sizes)
+    if n >= total_units or n < 2:
+        return estimate, 0.0
+    residuals = sum((t - ratio * b) ** 2 for t, b in zip(tokens, sizes)) / (n - 1)
+    fraction = n / total_units
+    return estimate, (1 - fraction) * total_units**2 * residuals / n
+
+
+def run_approx(
+    args: argparse.Namespace,
+    inputs: Iterable[InputItem],
+    ctx: CountContext,
+    encodings: List[str],
+    jobs: int,
+) -> dict:
+    """Estimate token totals from a stratified sample; return the report.
+
+    Strata are file extensions (tokens per byte differ a lot between prose,
+    code and data). Files over ``APPROX_CHUNK_BYTES`` are split into chunks so
+    one huge log is sampled rather than read whole. Strata with at most
+    ``APPROX_MIN_UNITS`` units are counted completely.
+    """
+    import random
+
+    started = time.perf_counter()
+    units, exact, skipped = sample_units(inputs, ctx)
+    strata: dict[str, List[SampleUnit]] = {}
+    for unit in units:
+        strata.setdefault(unit.stratum, []).append(unit)
+    rng = random.Random(args.seed)
+    chosen: List[SampleUnit] = []
+    for name in sorted(strata):
+        members = strata[name]
+        want = max(APPROX_MIN_UNITS, math.ceil(args.sample_fraction * len(members)))
+        chosen.extend(members if want >= len(members) else rng.sample(members, want))
+
+    counting = time.perf_counter()
+
+    def count(unit: SampleUnit) -> List[int]:
+        return count_unit(unit, ctx)
+
+    measured = list(ordered_map(count, chosen, jobs))
+    exact_results = list(iter_results(exact, ctx, jobs))
+    done = time.perf_counter()
+
+    n_enc = len(encodings)
+    estimates = [0.0] * n_enc
+    variances = [0.0] * n_enc
+    for result in exact_results:
+        if result.status == "ok":
+            for index, tokens in enumerate((result.tokens or 0, *result.extra_tokens)):
+                estimates[index] += tokens
+        else:
+            skipped.append(result)
+    by_stratum: dict[str, tuple[List[int], List[List[int]]]] = {}
+    for unit, counts in zip(chosen, measured):
+        sizes, tokens = by_stratum.setdefault(unit.stratum, ([], []))
+        sizes.append(unit.size)
+        tokens.append(counts)
+    strata_report = []
+    for name in sorted(strata):
+        members = strata[name]
+        total_bytes = sum(unit.size for unit in members)
+        sizes, tokens = by_stratum.get(name, ([], []))
+        row = {
+            "stratum": name,
+            "bytes": total_bytes,
+            "units": len(members),
+            "sampled_units": len(sizes),
+        }
+        for index in range(n_enc):
+            column = [counts[index] for counts in tokens]
+            estimate, variance = estimate_stratum(
+                sizes, column, len(members), total_bytes
+            )
+            estimates[index] += estimate
+            variances[index] += variance
+            if index == 0:
+                row["tokens"] = round(estimate)
+                row["margin"] = round(APPROX_Z * math.sqrt(variance))
+        strata_report.append(row)
+
+    sampled_bytes = sum(unit.size for unit in chosen)
+    total_bytes = sum(unit.size for unit in units)
+    elapsed = done - started
+    # Encoding time scales with bytes, so an exact run would spend the
+    # counting phase's time per sampled byte on every byte.
+    count_seconds = done - counting
+    scale = total_bytes / sampled_bytes if sampled_bytes else 1.0
+    exact_seconds = (counting - started) + count_seconds * scale
+    margins = [APPROX_Z * math.sqrt(variance) for variance in variances]
+    report = {
+        "tokens": round(estimates[0]),
+        "tokens_low": max(0, round(estimates[0] - margins[0])),
+        "tokens_high": round(estimates[0] + margins[0]),
+        "confidence": 0.95,
+        "bytes": total_bytes,
+        "sampled_bytes": sampled_bytes,
+        "units": len(units),
+        "sampled_units": len(chosen),
+        "skipped": len(skipped),
+        "seconds": round(elapsed, 3),
+        "exact_seconds_estimate": round(exact_seconds, 3),
+        "speedup": round(exact_seconds / elapsed, 1) if elapsed else 1.0,
+        "strata": strata_report,
+    }
+    if n_enc > 1:
+        report["tokens_by_encoding"] = {
+            name: {"tokens": round(value), "margin": round(margin)}
+            for name, value, margin in zip(encodings, estimates, margins)
+        }
+    if ctx.cache is not None:
+        report["cache_hits"] = ctx.cache.hits
+        report["cache_misses"] = ctx.cache.misses
+    report["skipped_items"] = [item_record(item, encodings) for item in skipped]
+    return report
+
+
+def emit_approx_human(report: dict, encodings: List[str], console: Console) -> None:
+    for row in report["strata"]:
+        console.print(
+            f"{row['stratum']} tokens~{row['tokens']} ±{row['margin']} "
+            f"bytes={row['bytes']} sampled={row['sampled_units']}/{row['units']}",
+            highlight=False,
+            markup=False,
+        )
+    margin = report["tokens_high"] - report["tokens"]
+    share = report["sampled_bytes"] / report["bytes"] if report["bytes"] else 1.0
+    console.print(
+        f"estimate tokens~{report['tokens']} ±{margin} "
+        f"(95% CI {report['tokens_low']}..{report['tokens_high']}) "
+        f"bytes={report['bytes']} sampled={share:.1%}",
+        highlight=False,
+        markup=False,
+        soft_wrap=True,
+    )
+    for name, value in report.get("tokens_by_encoding", {}).items():
+        console.print(
+            f"  {name} tokens~{value['tokens']} ±{value['margin']}",
+            highlight=False,
+            markup=False,
+        )
+    exact_seconds = report["exact_seconds_estimate"]
+    console.print(
+        f"took {report['seconds']:.2f}s; exact count ~{exact_seconds:.2f}s "
+        f"(~{report['speedup']}x faster)",
+        highlight=False,
+        markup=False,
+    )
+
+
+class Inotify:
+    """Directory watches through Linux inotify(7), called via ctypes.
+
+    Files are watched through their directory so editors that save by
+    writing a temporary file and renaming it over the original are seen.
+    """
+
+    def __init__(self) -> None:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: dict[int, set[str]] = {}
+        self._watched: set[str] = set()
+
+    def add(self, directory: str) -> None:
+        if directory in self._watched:
+            return
+        mask = IN_CLOSE_WRITE | IN_STRUCTURAL | IN_ONLYDIR
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            return
+        self._watched.add(directory)
+        self._dirs.setdefault(wd, set()).add(directory)
+
+    def wait(self) -> List[tuple[str, str, bool]]:
+        """Block until something changes; return ``(dir, name, structural)``.
+
+        Events are collected until the watch has been quiet for
+        ``WATCH_DEBOUNCE_SECONDS`` so one save is reported once.
+        """
+        import select
+        import struct
+
+        select.select([self.fd], [], [])
+        events: List[tuple[str, str, bool]] = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                if not select.select([self.fd], [], [], WATCH_DEBOUNCE_SECONDS)[0]:
+                    return events
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = struct.unpack_from("iIII", data, offset)
+                name = os.fsdecode(
+                    data[offset + 16 : offset + 16 + length].rstrip(b"\0")
+                )
+                offset += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    events.extend((directory, "", True) for directory in self._watched)
+                elif mask & IN_IGNORED:
+                    self._watched.difference_update(self._dirs.pop(wd, ()))
+                else:
+                    structural = bool(mask & IN_STRUCTURAL)
+                    for directory in self._dirs.get(wd, ()):
+                        events.append((directory, name, structural))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def scan_dir(directory: str) -> dict[str, tuple[int, int, bool]] | None:
+    snapshot: dict[str, tuple[int, int, bool]] = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        snapshot[entry.name] = (0, 0, True)
+                    else:
+                        info = entry.stat(follow_symlinks=False)
+                        snapshot[entry.name] = (info.st_mtime_ns, info.st_size, False)
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    return snapshot
+
+
+class PollWatcher:
+    """Fallback for platforms without inotify: rescan watched directories."""
+
+    def __init__(self) -> None:
+        self._snapshots: dict[str, dict[str, tuple[int, int, bool]]] = {}
+
+    def add(self, directory: str) -> None:
+        if directory not in self._snapshots:
+            snapshot = scan_dir(directory)
+            if snapshot is not None:
+                self._snapshots[directory] = snapshot
+
+    def wait(self) -> List[tuple[str, str, bool]]:
+        while True:
+            time.sleep(WATCH_POLL_SECONDS)
+            events: List[tuple[str, str, bool]] = []
+            for directory, before in list(self._snapshots.items()):
+                after = scan_dir(directory)
+                if after is None:
+                    del self._snapshots[directory]
+                    events.append((directory, "", True))
+                    continue
+                self._snapshots[directory] = after
+                for name in before.keys() | after.keys():
+                    old, new = before.get(name), after.get(name)
+                    if old != new:
+                        structural = old is None or new is None or new[2]
+                        events.append((directory, name, structural))
+            if events:
+                return events
+
+    def close(self) -> None:
+        pass
+
+
+def open_watcher() -> Inotify | PollWatcher:
+    try:
+        return Inotify()
+    except OSError:
+        return PollWatcher()
+
+
+def watch(
+    args: argparse.Namespace,
+    inputs: List[InputItem],
+    watcher: Inotify | PollWatcher,
+    ctx: CountContext,
+    encodings: List[str],
+    jobs: int,
+) -> int:
+    """Count ``inputs`` once, then recount only files that change.
+
+    Content edits re-encode just the saved file. Creations, deletions and
+    renames re-walk only the entry they name (a whole subtree for a new
+    directory), so editor swap files and rename-on-save stay cheap; a
+    changed ``.gitignore`` re-walks its directory argument. Totals are
+    re-derived from the kept per-file results after every batch of changes.
+    """
+    roots = [path for path in args.paths if path != "-" and os.path.isdir(path)]
+    prefixes = [(root, os.path.join(root, "")) for root in roots]
+
+    def root_for(path: str) -> str | None:
+        for root, prefix in prefixes:
+            if path == root or path.startswith(prefix):
+                return root
+        return None
+
+    # Explicit files and paths from stdin are watched through their parents;
+    # events name them relative to that directory, so match on normpath.
+    pinned = {
+        os.path.normpath(item.id): item.id
+        for item in inputs
+        if item.kind == "path" and root_for(item.id) is None
+    }
+    for path in pinned.values():
+        watcher.add(os.path.dirname(path) or ".")
+
+    # Results per input path; archives contribute one per member.
+    results: dict[str, List[ResultItem]] = {}
+    for item in iter_results(inputs, ctx, jobs):
+        results.setdefault(archive_source(item.id), []).append(item)
+    human = not args.ndjson
+    if human:
+        from rich.console import Console
+
+        out_console = Console(file=sys.stdout)
+        err_console = Console(file=sys.stderr, stderr=True)
+
+    def summarize() -> tuple[dict[str, ResultItem], dict]:
+        running = Totals(encodings)
+        marked = {}
+        for item in mark_duplicates(chain.from_iterable(results.values())):
+            running.add(item)
+            marked[item.id] = item
+        if ctx.cache is not None:
+            ctx.cache.flush()
+        return marked, running.as_dict(ctx.cache)
+
+    marked, totals = summarize()
+    if human:
+        emit_human(list(marked.values()), totals, encodings, out_console, err_console)
+        err_console.print(
+            f"watching {len(results)} inputs (Ctrl-C to stop)", highlight=False
+        )
+    else:
+        emit_ndjson_items(marked.values(), encodings)
+        emit_ndjson_total(totals, encodings, args.max_bytes)
+
+    try:
+        while True:
+            changed: set[str] = set()
+            rewalk: set[str] = set()
+            touched: set[tuple[str, str]] = set()  # (root, created/removed path)
+            for directory, name, structural in watcher.wait():
+                path = os.path.join(directory, name) if name else directory
+                if path in results:
+                    changed.add(path)
+                elif os.path.normpath(path) in pinned:
+                    changed.add(pinned[os.path.normpath(path)])
+                root = root_for(directory)
+                if root is None:
+                    continue
+                if name == ".gitignore" or (structural and path == root):
+                    rewalk.add(root)
+                elif structural:
+                    touched.add((root, path))
+
+            removed: List[str] = []
+            scopes = [(root, root) for root in rewalk]
+            scopes += [(root, path) for root, path in touched if root not in rewalk]
+            for root, scope in scopes:
+                subpath = None if scope == root else scope
+                found = set(walk_files(root, args, watcher.add, subpath))
+                prefix = os.path.join(scope, "")
+                for item_id in list(results):
+                    if (
+                        (item_id == scope or item_id.startswith(prefix))
+                        and os.path.normpath(item_id) not in pinned
+                        and item_id not in found
+                    ):
+                        del results[item_id]
+                        removed.append(item_id)
+                changed.update(found - results.keys())
+            changed.difference_update(removed)
+            if not changed and not removed:
+                continue
+
+            if ctx.dedup is not None:
+                ctx = ctx._replace(dedup=ContentIndex())
+            items = [InputItem(id=path, kind="path", path=path) for path in changed]
+            items.sort(key=lambda item: item.id)
+            for item in items:
+                results[item.id] = []
+            for result in iter_results(items, ctx, jobs):
+                results[archive_source(result.id)].append(result)
+
+            marked, totals = summarize()
+            updated = [marked[r.id] for item in items for r in results[item.id]]
+            if human:
+                for item in updated:
+                    if item.status == "ok":
+                        print_item(out_console, item, encodings)
+                    else:
+                        print_skip(err_console, item)
+                for item_id in sorted(removed):
+                    out_console.print(
+                        f"removed {item_id}", highlight=False, markup=False
+                    )
+                print_total(out_console, totals, encodings)
+            else:
+                emit_ndjson_items(updated, encodings)
+                for item_id in sorted(removed):
+                    sys.stdout.write(json.dumps({"id": item_id, "status": "removed"}))
+                    sys.stdout.write("\n")
+                emit_ndjson_total(totals, encodings, args.max_bytes)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+class HFEncoder:
+    """Counts with a HuggingFace ``tokenizer.json`` behind tiktoken's ``encode``.
+
+    ``name`` includes a digest of the file so cached counts never mix
+    tokenizers that share a file name.
+    """
+
+    def __init__(self, label: str, path: str) -> None:
+        try:
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise ValueError(
+                f"{path}: HuggingFace tokenizers need the 'tokenizers' package"
+            ) from None
+        with open(path, "rb") as handle:
+            data = handle.read()
+        self.name = f"{label}@{content_digest(data).hex()[:12]}"
+        self._tokenizer = Tokenizer.from_str(data.decode("utf-8"))
+
+    def encode(self, text: str, disallowed_special: tuple = ()) -> List[int]:
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+
+
+_encoders: dict[tuple[str, str], tiktoken.Encoding | HFEncoder] = {}
+
+
+def default_tokenizer_dir() -> str:
+    configured = os.environ.get("TOKEN_SUMMARY_TOKENIZERS")
+    if configured:
+        return configured
+    base = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    return os.path.join(base, "dot-agents", "tokenizers")
+
+
+def load_ranks(
+    source: str, expected_hash: str | None
+) -> tuple[dict[bytes, int], str | None]:
+    """Parse a tiktoken rank file (path or URL) through a marshal cache.
+
+    Returns the ranks and the file's sha256. Parsing base64 ranks costs tens
+    of milliseconds per encoding; the marshalled dict loads several times
+    faster. Local files are keyed by path, size and mtime and hashed when
+    they are parsed; URLs are keyed by URL and verified against
+    ``expected_hash`` by tiktoken.
+    """
+    import marshal
+
+    from tiktoken.load import load_tiktoken_bpe
+
+    local = os.path.exists(source)
+    if local:
+        info = os.stat(source)
+        key = f"v2:{os.path.realpath(source)}:{info.st_size}:{info.st_mtime_ns}"
+    else:
+        key = f"v2:{source}:{expected_hash}"
+    cache_dir = os.path.join(os.path.dirname(default_cache_path()), "tokenizers")
+    cached = os.path.join(cache_dir, content_digest(key.encode()).hex() + ".marshal")
+    try:
+        with open(cached, "rb") as handle:
+            digest, ranks = marshal.load(handle)
+        return ranks, digest
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    if local:
+        import hashlib
+
+        with open(source, "rb") as handle:
+            digest = hashlib.sha256(handle.read()).hexdigest()
+        ranks = load_tiktoken_bpe(source, expected_hash=None)
+    else:
+        digest = expected_hash
+        ranks = load_tiktoken_bpe(source, expected_hash=expected_hash)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        partial = f"{cached}.{os.getpid()}.tmp"
+        with open(partial, "wb") as handle:
+            marshal.dump((digest, ranks), handle)
+        os.replace(partial, cached)
+    except OSError:
+        pass
+    return ranks, digest
+
+
+def tiktoken_encoding(name: str, source: str) -> tiktoken.Encoding:
+    import tiktoken
+
+    if name not in TIKTOKEN_ENCODINGS:
+        known = ", ".join(TIKTOKEN_ENCODINGS)
+        raise ValueError(
+            f"{source}: no pattern known for {name!r} (rank files must be "
+            f"named after one of: {known})"
+        )
+    pat_str, special_tokens, expected_hash = TIKTOKEN_ENCODINGS[name]
+    ranks, digest = load_ranks(source, expected_hash)
+    # The name keys the token cache, so a rank file that is not the published
+    # one gets a digest-qualified name, like HFEncoder.
+    label = name if digest == expected_hash else f"{name}@{(digest or '')[:12]}"
+    return tiktoken.Encoding(
+        label,
+        pat_str=pat_str,
+        mergeable_ranks=ranks,
+        special_tokens=special_tokens,
+    )
+
+
+def load_encoder(spec: str, directory: str) -> tiktoken.Encoding | HFEncoder:
+    """Resolve one --encoding entry; the first match wins.
+
+    1. A path to a ``.tiktoken`` rank file or ``tokenizer.json``.
+    2. ``DIR/spec.tiktoken``, ``DIR/spec.json`` or ``DIR/spec/tokenizer.json``.
+    3. A known tiktoken name, downloaded once and cached by tiktoken.
+    4. Any other name registered with tiktoken.
+    """
+    if spec.endswith(".tiktoken") and os.path.isfile(spec):
+        return tiktoken_encoding(os.path.basename(spec)[: -len(".tiktoken")], spec)
+    if spec.endswith(".json") and os.path.isfile(spec):
+        label = os.path.basename(spec)[: -len(".json")]
+        if label == "tokenizer":
+            label = os.path.basename(os.path.dirname(os.path.abspath(spec)))
+        return HFEncoder(label, spec)
+    local = os.path.join(directory, f"{spec}.tiktoken")
+    if os.path.isfile(local):
+        return tiktoken_encoding(spec, local)
+    for local in (
+        os.path.join(directory, f"{spec}.json"),
+        os.path.join(directory, spec, "tokenizer.json"),
+    ):
+        if os.path.isfile(local):
+            return HFEncoder(spec, local)
+    if spec in TIKTOKEN_ENCODINGS:
+        try:
+            return tiktoken_encoding(spec, f"{TIKTOKEN_BASE_URL}{spec}.tiktoken")
+        except Exception as exc:
+            raise ValueError(
+                f"Cannot load encoding {spec}: {exc} (for offline use, put "
+                f"{spec}.tiktoken in {directory})"
+            ) from exc
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding(spec)
+    except Exception as exc:
+        raise ValueError(f"Unknown encoding: {spec}") from exc
+
+
+def emit_groups_human(
+    rows: List[dict], stats: GroupStats, totals: dict, console: Console
+) -> None:
+    for row in rows:
+        console.print(
+            f"{row['group']} files={row['files']} tokens={row['tokens']} "
+            f"p50={row['p50']} p95={row['p95']} max={row['max']} "
+            f"bytes={row['bytes']}",
+            highlight=False,
+            markup=False,
+            soft_wrap=True,
+        )
+    print_total(console, totals, stats.encodings)
+    if stats.skipped_reasons:
+        print_skip_reasons(console, stats.skipped_reasons)
+
+
+def load_encoders(
+    names: List[str], directory: str | None = None
+) -> List[tiktoken.Encoding | HFEncoder]:
+    """Load encoders once per process; the server reuses them across requests."""
+    directory = directory or default_tokenizer_dir()
+    encoders = []
+    for name in names:
+        key = (name, directory)
+        if key not in _encoders:
+            _encoders[key] = load_encoder(name, directory)
+        encoders.append(_encoders[key])
+    return encoders
+
+
+def default_socket_path() -> str:
+    if os.environ.get("TOKEN_SUMMARY_SOCKET"):
+        return os.environ["TOKEN_SUMMARY_SOCKET"]
+    base = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "dot-agents"
+    )
+    return os.path.join(base, "dot-agents-token-summary.sock")
+
+
+class RequestStdin(io.TextIOWrapper):
+    """Client stdin replayed inside the server, including its tty-ness."""
+
+    def __init__(self, data: bytes, tty: bool) -> None:
+        super().__init__(io.BytesIO(data), encoding="utf-8", errors="replace")
+        self._tty = tty
+
+    def isatty(self) -> bool:
+        return self._tty
+
+
+def handle_request(rfile: BinaryIO, wfile: BinaryIO) -> None:
+    """Run one forwarded invocation: a JSON header line, then raw stdin bytes."""
+    line = rfile.readline()
+    if not line:  # a liveness probe from stale_socket()
+        return
+    request = json.loads(line)
+    stdin_data = rfile.read()
+    stdout, stderr = io.StringIO(), io.StringIO()
+    saved = (sys.stdin, sys.stdout, sys.stderr, os.getcwd())
+    try:
+        os.chdir(request["cwd"])
+        sys.stdin = RequestStdin(stdin_data, request.get("stdin_tty", True))
+        sys.stdout, sys.stderr = stdout, stderr
+        forwarded = parse_args(build_parser(), request["argv"])
+        # Requests run serially, so a never-ending --watch, or a --connect
+        # back to this same socket, would hang the server for every client.
+        if forwarded.serve or forwarded.watch or forwarded.connect:
+            raise SystemExit(
+                "--serve, --watch and --connect cannot be forwarded to a server"
+            )
+        code = main(request["argv"])
+    except SystemExit as exc:
+        if isinstance(exc.code, str):
+            stderr.write(exc.code + "\n")
+        code = exc.code if isinstance(exc.code, int) else int(exc.code is not None)
+    except Exception:
+        import traceback
+
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = saved[:3]
+        os.chdir(saved[3])
+    response = {
+        "code": code,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+    }
+    wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def stale_socket(path: str) -> bool:
+    """True if ``path`` is a socket that no server is listening on."""
+    import socket
+
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return False
+    except OSError:
+        return True
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return True
+        except OSError:
+            return False
+    return False
+
+
+def serve(path: str, encodings: List[str], tokenizer_dir: str | None) -> int:
+    """Serve requests one at a time; encoders stay loaded between requests.
+
+    Requests run serially because each swaps the process-wide cwd and std
+    streams; per-request work still uses the --jobs pool.
+    """
+    import signal
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            handle_request(self.rfile, self.wfile)
+
+    load_encoders(encodings, tokenizer_dir)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.lexists(path):
+        if not stale_socket(path):
+            sys.stderr.write(f"{path}: in use by a running server or not a socket\n")
+            return 1
+        os.unlink(path)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with socketserver.UnixStreamServer(path, Handler) as server:
+        os.chmod(path, 0o600)
+        sys.stderr.write(f"token-summary serving on {path}\n")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+    return 0
+
+
+def forwarded_argv(
+    parser: argparse.ArgumentParser, args: argparse.Namespace
+) -> List[str]:
+    """Rebuild ``args`` as canonical argv for the server, minus --connect.
+
+    Rebuilding from the parsed namespace (rather than filtering the raw
+    strings) also drops abbreviations such as ``--conn``.
+    """
+    argv: List[str] = []
+    for action in parser._actions:
+        value = getattr(args, action.dest, None)
+        if not action.option_strings or action.dest in ("help", "connect"):
+            continue
+        flag = action.option_strings[0]
+        if isinstance(action, argparse._StoreTrueAction):
+            argv += [flag] if value else []
+        elif isinstance(action, argparse._AppendAction):
+            for item in value or []:
+                argv += [flag, str(item)]
+        elif value != action.default:
+            argv += [flag, str(value)]
+    return [*argv, "--", *args.paths]
+
+
+def run_client(path: str, argv: List[str], args: argparse.Namespace) -> int | None:
+    """Forward ``argv`` to the server; return None when no server is listening."""
+    import socket
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    except OSError:
+        return None
+    stdin_tty = sys.stdin.isatty()
+    wants_stdin = "-" in args.paths or choose_stdin_mode(args) != "ignore"
+    header = {"argv": argv, "cwd": os.getcwd(), "stdin_tty": stdin_tty}
+    with sock:
+        sock.sendall(json.dumps(header).encode("utf-8") + b"\n")
+        if wants_stdin and not stdin_tty:
+            sock.sendall(read_stdin_bytes())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as reply:
+            response = json.loads(reply.readline())
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["code"]
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = build_parser()
+    args = parse_args(parser, argv)
+    socket_path = args.socket or default_socket_path()
+
+    if args.serve and args.connect:
+        parser.error("--serve cannot be combined with --connect")
+    if args.serve:
+        return serve(socket_path, parse_encodings(args.encoding), args.tokenizer_dir)
+    # --watch never returns, so it always runs locally rather than
+    # occupying the single-threaded server.
+    if args.connect and not args.watch:
+        code = run_client(socket_path, forwarded_argv(parser, args), args)
+        if code is not None:
+            return code
+
+    if args.max_bytes < 0:
+        parser.error("--max-bytes must be >= 0")
+    if args.jobs < 0:
+        parser.error("--jobs must be >= 0")
+    if args.cache_max_entries < 0:
+        parser.error("--cache-max-entries must be >= 0")
+    if args.top is not None and args.top < 0:
+        parser.error("--top must be >= 0")
+    if args.watch and (args.json or args.top is not None or args.budget is not None):
+        parser.error("--watch cannot be combined with --json, --top or --budget")
+    if args.git_diff and args.watch:
+        parser.error("--git-diff cannot be combined with --watch")
+    if args.approx and (
+        args.watch
+        or args.git_diff
+        or args.by_section
+        or args.top is not None
+        or args.budget is not None
+    ):
+        parser.error(
+            "--approx cannot be combined with --watch, --git-diff, --by-section, "
+            "--top or --budget"
+        )
+    group_by = group_key(args.group_by) if args.group_by else None
+    if args.group_by and group_by is None:
+        parser.error("--group-by expects ext, dir or depth=N")
+    if group_by is not None and (
+        args.watch or args.approx or args.git_diff or args.top is not None
+    ):
+        parser.error(
+            "--group-by cannot be combined with --watch, --approx, --git-diff or --top"
+        )
+    if not 0 < args.sample_fraction <= 1:
+        parser.error("--sample-fraction must be in (0, 1]")
+    if args.git_diff and ".." not in args.git_diff:
+        parser.error("--git-diff expects a revision range such as main..HEAD")
+    jobs = args.jobs or os.cpu_count() or 1
+
+    watcher = open_watcher() if args.watch else None
+    if args.git_diff:
+        try:
+            entries = git_diff_entries(args.git_diff, args.paths)
+        except (OSError, ValueError) as exc:
+            sys.stderr.write(f"{exc}\n")
+            return 2
+    else:
+        pending = collect_inputs(args, watcher.add if watcher is not None else None)
+        first = next(pending, None)
+        if first is None:
+            parser.print_help()
+            return 2
+        inputs = chain([first], pending)
+
+    encodings = list(dict.fromkeys(parse_encodings(args.encoding)))
+    if not encodings:
+        parser.error("--encoding must name at least one encoding")
+    try:
+        encoders = load_encoders(encodings, args.tokenizer_dir)
+    except ValueError as exc:
+        sys.stderr.write(f"{exc}\n")
+        return 2
+    if args.by_section and not hasattr(encoders[0], "decode_tokens_bytes"):
+        parser.error("--by-section needs a tiktoken encoding first in --encoding")
+    # Report resolved names, so a rank-file path shows as its encoding.
+    encodings = [encoder.name for encoder in encoders]
+
+    # tiktoken releases the GIL while encoding, so threads scale across cores.
+    ctx = CountContext(
+        encoders=encoders,
+        max_bytes=args.max_bytes,
+        cache=open_cache(args),
+        stream=args.stream,
+        by_section=args.by_section,
+        dedup=None if args.no_dedup else ContentIndex(),
+        archives=not args.no_archives,
+    )
+    if watcher is not None:
+        try:
+            return watch(args, list(inputs), watcher, ctx, encodings, jobs)
+        finally:
+            if ctx.cache is not None:
+                ctx.cache.close()
+    if args.approx:
+        try:
+            report = run_approx(args, inputs, ctx._replace(dedup=None), encodings, jobs)
+        finally:
+            if ctx.cache is not None:
+                ctx.cache.close()
+        skipped_items = report.pop("skipped_items")
+        if args.json or args.ndjson:
+            payload = {
+                "encoding": encoding_field(encodings),
+                "max_bytes": args.max_bytes,
+                "approx": report,
+                "skipped": skipped_items,
+            }
+            indent = 2 if args.json else None
+            sys.stdout.write(json.dumps(payload, indent=indent) + "\n")
+        else:
+            from rich.console import Console
+
+            emit_approx_human(report, encodings, Console(file=sys.stdout))
+            err_console = Console(file=sys.stderr, stderr=True)
+            for record in skipped_items:
+                err_console.print(
+                    f"SKIP {record['id']} reason={record['reason']}",
+                    highlight=False,
+                    markup=False,
+                )
+        return 0 if report["units"] or report["tokens"] else 1
+    running = Totals(encodings, budget=args.budget, delta=bool(args.git_diff))
+    if args.git_diff:
+
+        def count_change(change: BlobChange) -> ResultItem:
+            return process_change(change, ctx)
+
+        counted = ordered_map(
+            count_change, iter_changes(entries, args, ctx.encoders), jobs
+        )
+    else:
+        counted = mark_duplicates(iter_results(inputs, ctx, jobs))
+    results_iter = tally(counted, running)
+    results: Iterable[ResultItem] = []
+    top: TopResults | None = None
+    groups = GroupStats(group_by, encodings) if group_by is not None else None
+    try:
+        if groups is not None:
+            for item in results_iter:
+                groups.add(item)
+        elif args.top is not None:
+            top = top_results(results_iter, args.top, by_delta=bool(args.git_diff))
+            results = top.items
+        elif args.ndjson:
+            emit_ndjson_items(results_iter, encodings)
+        else:
+            results = ResultStore(len(encodings))
+            results.extend(results_iter)
+    finally:
+        results_iter.close()
+        if ctx.cache is not None:
+            ctx.cache.close()
+    totals = running.as_dict(ctx.cache)
+
+    if groups is not None:
+        rows = groups.rows()
+        if args.ndjson:
+            for row in rows:
+                sys.stdout.write(json.dumps(row) + "\n")
+            emit_ndjson_total(totals, encodings, args.max_bytes)
+        elif args.json:
+            payload = {
+                "encoding": encoding_field(encodings),
+                "max_bytes": args.max_bytes,
+                "group_by": args.group_by,
+                "groups": rows,
+                "total": totals,
+            }
+            sys.stdout.write(json.dumps(payload, indent=2) + "\n")
+        else:
+            from rich.console import Console
+
+            emit_groups_human(rows, groups, totals, Console(file=sys.stdout))
+    elif args.ndjson:
+        if args.top is not None:
+            emit_ndjson_items(results, encodings)
+        emit_ndjson_total(totals, encodings, args.max_bytes)
+    elif args.json:
+        emit_json(results, totals, encodings, args.max_bytes)
+    else:
+        from rich.console import Console
+
+        out_console = Console(file=sys.stdout)
+        err_console = Console(file=sys.stderr, stderr=True)
+        if top is not None:
+            results = [*top.items, *top.skipped]
+        emit_human(results, totals, encodings, out_console, err_console)
+        if top is not None and len(top.skipped) < totals["skipped"]:
+            print_skip_reasons(
+                err_console, top.skipped_reasons, totals["skipped"] - len(top.skipped)
+            )
 
-    if totals["ok"] == 0:
+    if running.over_budget:
+        return EXIT_OVER_BUDGET
+    if totals["ok"] == 0 and not args.git_diff:
         return 1
     if args.fail_on_skip and totals["skipped"] > 0:
         return 1
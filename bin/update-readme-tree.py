@@ -1,33 +1,23 @@
-#!/usr/bin/env -S pixi exec --spec python=3.12 -- python
+#!/usr/bin/env -S pixi exec --spec python=3.12 --spec pyyaml -- python
 """Update the README agents/skills tree section between markers."""
 
 from __future__ import annotations
 
 import argparse
 import re
-import subprocess
 import sys
 from pathlib import Path
 
+from agents_catalog import build_tree_content, collect_agents, collect_skills
+
 
 def get_tree_output(src_path: Path) -> str:
-    """Run list-agents-skills.py and return plain tree output."""
-    script = Path(__file__).parent / "list-agents-skills.py"
-    result = subprocess.run(
-        [
-            str(script),
-            "--format",
-            "tree",
-            "--show-descriptions",
-            "--no-color",
-            "--src",
-            str(src_path),
-        ],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
-    return result.stdout.strip()
+    """Build the plain agents/skills tree in-process."""
+    agents = collect_agents(src_path)
+    skills = collect_skills(src_path)
+    tree = build_tree_content(skills, agents, show_descriptions=True)
+    # Same summary line list-agents-skills.py prints under the tree
+    return f"{tree}\n\nTotal: {len(agents)} agents, {len(skills)} skills"
 
 
 def update_readme(readme_path: Path, tree_content: str) -> bool:
@@ -100,8 +90,8 @@ def main() -> int:
 
     try:
         tree_content = get_tree_output(src_path)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running list-agents-skills.py: {e}", file=sys.stderr)
+    except OSError as e:
+        print(f"Error reading catalog: {e}", file=sys.stderr)
         return 1
 
     if args.check: